@@ -1,3 +1,11 @@
 from .config import Config
 from .database import Database
-from .interfaces import JSONInterface, interfaces
\ No newline at end of file
+from .interfaces import JSONInterface, JournalInterface, SQLiteInterface, ShardedInterface, interfaces
+from .principals import Principal, PrincipalCache
+from .history import HistoryStore, RingBuffer, RollupBuffer
+from .subscriptions import SubscriptionHub
+from .events import EventEngine, Rule
+from .alerts import AlertDispatcher, Template
+from .phones import PhoneIndex
+from .usage import KeyUsage
+from .backups import BackupManager
\ No newline at end of file
@@ -0,0 +1,310 @@
+import asyncio
+import collections
+import re
+import time
+
+import api
+from ..utils import exceptions
+from ..utils import logger
+from . import transports
+
+class Template:
+    def __init__(
+            self,
+            text: str
+        ) -> None:
+        """
+        Constructs a Template object.
+
+        Splits a format like "[%node%] FAULT: %device%"
+        into literal text and field names once, so
+        rendering is a single join.
+
+        Parameters:
+            text (str): Format string, with %field% placeholders
+        """
+
+        self.text = text
+
+        # Odd indexes are field names
+        self.parts = re.split(r"%(\w+)%", text)
+
+    def render(
+            self,
+            values: dict
+        ) -> str:
+        """
+        Fills in the placeholders. Unknown fields are
+        left as they were.
+        """
+
+        return "".join(
+            part if i % 2 == 0 else str(values.get(part, f"%{part}%"))
+            for i, part in enumerate(self.parts)
+        )
+
+class AlertDispatcher:
+    def __init__(
+            self,
+            transport: str = "twilio",
+            workers: int = 2,
+            queue_size: int = 256,
+            rate_limit: float = 10,
+            retries: int = 3,
+            backoff: float = 1
+        ) -> None:
+        """
+        Constructs an AlertDispatcher object.
+
+        Alerts are rendered and queued without any I/O,
+        then sent by a pool of worker tasks, so bursts
+        of faults never add latency to the request that
+        caused them.
+
+        Parameters:
+            transport (str): Transport to send with
+                Can be anything in api.classes.transports.
+            workers (int): Worker tasks sending messages
+            queue_size (int): Messages to buffer. Further
+                messages are dropped while the queue is full.
+                Each phone can also hold this many messages
+                back for its rate limit.
+            rate_limit (float): Minimum seconds between
+                messages to the same phone. Messages sent
+                sooner wait on their own, without holding up
+                a worker or other phones.
+            retries (int): Attempts to make per message
+            backoff (float): Seconds to wait after the first
+                failed attempt, doubling after each one
+        """
+
+        if transport not in transports.transports:
+            raise exceptions.TransportError(f"Invalid transport {transport}")
+
+        self.transport_type = transport
+        self.transport = None
+
+        self.workers = workers
+        self.queue_size = queue_size
+        self.rate_limit = rate_limit
+        self.retries = retries
+        self.backoff = backoff
+
+        self.templates = {}
+
+        self.queue = None
+        self.tasks = []
+
+        self.next_allowed = {}
+        self.dropped = 0
+
+        # Phone number -> messages waiting for their slot,
+        # and the timer that releases the next one
+        self.pending = {}
+        self.timers = {}
+
+    def configure(
+            self,
+            settings: dict
+        ) -> None:
+        """
+        Compiles message formats and passes credentials to
+        the transport. Should be called whenever settings change.
+
+        Arguments:
+            settings (dict): Database settings
+        """
+
+        self.templates = {
+            name[:-len("_format")]: Template(value)
+            for name, value in settings.items() if name.endswith("_format")
+        }
+
+        if self.transport is None:
+            self.transport = transports.transports[self.transport_type](settings)
+
+        else:
+            self.transport.configure(settings)
+
+    def start(
+            self
+        ) -> None:
+        """
+        Starts the worker tasks. Must be called from
+        the serving event loop.
+        """
+
+        self.queue = asyncio.Queue(self.queue_size)
+
+        self.tasks = [
+            asyncio.get_running_loop().create_task(self.worker())
+            for i in range(self.workers)
+        ]
+
+    async def stop(
+            self
+        ) -> None:
+        """
+        Stops the worker tasks. Anything still queued is dropped.
+        """
+
+        for timer in self.timers.values():
+            timer.cancel()
+
+        self.timers = {}
+        self.pending = {}
+
+        for task in self.tasks:
+            task.cancel()
+
+        await asyncio.gather(*self.tasks, return_exceptions = True)
+
+        self.tasks = []
+
+    def send(
+            self,
+            number: str,
+            template: str,
+            values: dict
+        ) -> bool:
+        """
+        Queues a message to a phone number.
+
+        Arguments:
+            number (str): Phone number to send to
+            template (str): Name of the format, like "fault"
+            values (dict): Values for the format's placeholders
+
+        Returns:
+            False if it was dropped
+        """
+
+        if self.queue is None or template not in self.templates:
+            return False
+
+        message = self.templates[template].render(values)
+
+        now = time.monotonic()
+        slot = self.next_allowed.get(number, 0)
+
+        if number not in self.pending and slot <= now:
+            return self.enqueue(number, message, now)
+
+        # Too soon, so hold it back until the phone's next slot
+        pending = self.pending.setdefault(number, collections.deque())
+
+        if len(pending) >= self.queue_size:
+            self.dropped += 1
+            return False
+
+        pending.append(message)
+
+        if number not in self.timers:
+            self.timers[number] = asyncio.get_running_loop().call_later(
+                slot - now,
+                self.release,
+                number
+            )
+
+        return True
+
+    def enqueue(
+            self,
+            number: str,
+            message: str,
+            now: float
+        ) -> bool:
+        """
+        Queues a rendered message for the workers, and
+        takes the phone's slot.
+        """
+
+        try:
+            self.queue.put_nowait((number, message))
+
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+
+        self.next_allowed[number] = now + self.rate_limit
+
+        return True
+
+    def release(
+            self,
+            number: str
+        ) -> None:
+        """
+        Timer callback that queues a phone's next held back
+        message once its slot comes up.
+        """
+
+        pending = self.pending[number]
+
+        self.enqueue(number, pending.popleft(), time.monotonic())
+
+        if pending:
+            self.timers[number] = asyncio.get_running_loop().call_later(
+                self.rate_limit,
+                self.release,
+                number
+            )
+
+        else:
+            del self.pending[number]
+            del self.timers[number]
+
+    async def fault(
+            self,
+            device: dict,
+            rule,
+            value
+        ) -> None:
+        """
+        Event handler for faults. Alerts every phone that
+        has the fault toggle on and is enrolled to the
+        device or its node.
+        """
+
+        try:
+            node = await api.db.get(
+                f"nodes/{device['node']}"
+            )
+
+        except exceptions.NotFound:
+            node = {"name": device["node"]}
+
+        values = {
+            "node": node["name"],
+            "device": device["name"],
+            "event": rule.name,
+            "value": value
+        }
+
+        by_node, missing = await api.db.phone_index.match("fault", node = device["node"])
+        by_device, missing = await api.db.phone_index.match("fault", device = device["uuid"])
+
+        for phone_uuid in by_node | by_device:
+            phone = await api.db.get(
+                f"phones/{phone_uuid}"
+            )
+
+            self.send(phone["number"], "fault", values)
+
+    async def worker(
+            self
+        ) -> None:
+        while True:
+            number, message = await self.queue.get()
+
+            for attempt in range(self.retries):
+                try:
+                    await self.transport.send(number, message)
+                    break
+
+                except Exception as e:
+                    if attempt + 1 == self.retries:
+                        logger.log("error", "Failed to send alert", number = number, error = str(e))
+
+                    else:
+                        await asyncio.sleep(self.backoff * 2 ** attempt)
@@ -0,0 +1,297 @@
+import asyncio
+import fcntl
+import gzip
+import os
+import time
+from typing import Optional
+
+from ..utils import codec
+from ..utils import exceptions
+from ..utils import logger
+from ..utils import misc
+
+class BackupManager:
+    def __init__(
+            self,
+            parent,
+            interval: float = 3600,
+            full_every: int = 24,
+            keep: int = 7,
+            path: Optional[str] = None
+        ) -> None:
+        """
+        Constructs a BackupManager object.
+
+        Writes gzipped backups of the database every
+        interval seconds. Every full_every-th backup is
+        a full copy, and the ones in between only hold the
+        entries that changed since the backup before them.
+        Since the database is copy-on-write, finding those
+        is a matter of comparing references, and the data
+        can be serialized on an executor thread while the
+        event loop carries on.
+
+        Parameters:
+            parent (Database): Database to back up
+            interval (float): Seconds between backups
+            full_every (int): Backups per chain, including
+                the full one it starts with
+            keep (int): Chains to keep. Older ones are deleted.
+            path (str): Folder for backups. Defaults to the
+                interface's backups folder.
+        """
+
+        self.parent = parent
+        self.interval = interval
+        self.full_every = full_every
+        self.keep = keep
+        self.path = path or f"{parent.interface.path}/backups"
+
+        # Snapshot the last backup was taken from, and its file
+        self.last = None
+        self.last_name = None
+        self.chain_length = 0
+
+        self.lock = asyncio.Lock()
+        self.task = None
+
+        # Held by whichever process takes backups, in shared mode
+        self.lock_file = None
+
+    @staticmethod
+    def diff(
+            old: dict,
+            new: dict
+        ):
+        """
+        Finds what changed between two snapshots, one
+        entry deep.
+
+        Returns:
+            dict of new values keyed by path, and a list
+            of deleted paths
+        """
+
+        put = {}
+        delete = []
+
+        for collection, entries in new.items():
+            previous = old.get(collection)
+
+            if previous is entries:
+                continue
+
+            if not isinstance(entries, dict) or not isinstance(previous, dict):
+                put[collection] = entries
+                continue
+
+            for name, entry in entries.items():
+                if previous.get(name) is not entry:
+                    put[f"{collection}/{name}"] = entry
+
+            delete += [f"{collection}/{name}" for name in previous if name not in entries]
+
+        delete += [collection for collection in old if collection not in new]
+
+        return put, delete
+
+    async def backup(
+            self
+        ) -> Optional[str]:
+        """
+        Takes a backup now.
+
+        Returns:
+            The backup's file name, or None if nothing
+            changed since the last one
+        """
+
+        async with self.lock:
+            self.parent.share()
+            data = self.parent.interface.data
+
+            if data is self.last:
+                return None
+
+            if self.last is None or self.chain_length >= self.full_every:
+                record = {
+                    "type": "full",
+                    "data": data
+                }
+                kind = "full"
+
+            else:
+                put, delete = self.diff(self.last, data)
+
+                record = {
+                    "type": "incremental",
+                    "base": self.last_name,
+                    "put": put,
+                    "delete": delete
+                }
+                kind = "incr"
+
+            record["time"] = time.time()
+            name = f"{int(record['time'] * 1000)}-{kind}.json.gz"
+
+            await asyncio.get_running_loop().run_in_executor(
+                None,
+                self.sync_write,
+                name,
+                record
+            )
+
+            self.chain_length = 1 if kind == "full" else self.chain_length + 1
+            self.last = data
+            self.last_name = name
+
+            return name
+
+    def sync_write(
+            self,
+            name: str,
+            record: dict
+        ) -> None:
+        os.makedirs(self.path, exist_ok = True)
+
+        misc.atomic_write(
+            f"{self.path}/{name}",
+            gzip.compress(codec.dumps(record).encode())
+        )
+
+        self.sync_prune()
+
+    def sync_prune(
+            self
+        ) -> None:
+        """
+        Deletes every chain older than the newest keep.
+        """
+
+        names = sorted(x for x in os.listdir(self.path) if x.endswith(".json.gz"))
+        fulls = [x for x in names if x.endswith("-full.json.gz")]
+
+        if len(fulls) <= self.keep:
+            return
+
+        oldest_kept = fulls[-self.keep]
+
+        for name in names:
+            if name < oldest_kept:
+                os.remove(f"{self.path}/{name}")
+
+    def acquire(
+            self
+        ) -> bool:
+        """
+        Checks whether this process should take backups.
+        When several processes share the database, only the
+        one holding the backups folder's lock file does, and
+        another takes over if it exits.
+        """
+
+        if not self.parent.shared:
+            return True
+
+        if self.lock_file is None:
+            os.makedirs(self.path, exist_ok = True)
+            self.lock_file = open(f"{self.path}/backups.lock", "a")
+
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+
+        except BlockingIOError:
+            return False
+
+    def start(
+            self
+        ) -> None:
+        """
+        Starts taking backups periodically. Must be called
+        from the serving event loop.
+        """
+
+        self.task = asyncio.get_running_loop().create_task(self.loop())
+
+    async def stop(
+            self
+        ) -> None:
+        """
+        Stops taking backups periodically, and takes a last one.
+        """
+
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+        if self.acquire():
+            await self.backup()
+
+    async def loop(
+            self
+        ) -> None:
+        while True:
+            try:
+                if self.acquire():
+                    await self.backup()
+
+            except Exception as e:
+                logger.log("error", "Backup failed", error = str(e))
+
+            await asyncio.sleep(self.interval)
+
+def restore(
+        path: str,
+        upto: Optional[str] = None
+    ) -> dict:
+    """
+    Rebuilds the database from a backup folder.
+
+    Arguments:
+        path (str): Backups folder
+        upto (str): Name of the last backup to apply. Defaults
+            to the newest one.
+
+    Returns:
+        dict
+    """
+
+    names = sorted(x for x in os.listdir(path) if x.endswith(".json.gz"))
+
+    if upto is not None:
+        names = [x for x in names if x <= upto]
+
+    # Walk back to the full backup the chain starts with
+    chain = []
+
+    for name in reversed(names):
+        chain.append(name)
+
+        if name.endswith("-full.json.gz"):
+            break
+
+    else:
+        raise exceptions.NotFound(f"No full backup in {path}")
+
+    data = None
+
+    for name in reversed(chain):
+        with open(f"{path}/{name}", "rb") as f:
+            record = codec.loads(gzip.decompress(f.read()))
+
+        if record["type"] == "full":
+            data = record["data"]
+            continue
+
+        for deleted in record["delete"]:
+            try:
+                misc.remove(data, deleted)
+
+            except exceptions.NotFound:
+                pass
+
+        for changed, value in record["put"].items():
+            misc.assign(data, changed, value)
+
+    return data
@@ -1,6 +1,8 @@
 import aiofiles
 import yaml
 
+from ..utils import logger
+
 class Config:
     def __init__(
             self,
@@ -26,7 +28,8 @@ class Config:
 
         async with aiofiles.open(self.path, mode = "r") as f:
             self.raw = yaml.safe_load(await f.read())["api"]
-            print(self.raw)
+
+        logger.log("info", "Loaded config", path = self.path, sections = list(self.raw))
 
         for key, value in self.raw.items():
             setattr(self, key, value)
\ No newline at end of file
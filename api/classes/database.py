@@ -1,15 +1,24 @@
-import json
-
+import asyncio
+import copy
+import inspect
+import time
+import uuid
+from typing import Optional
 
 import api
 from ..utils import exceptions
+from ..utils import logger
+from ..utils import metrics
 from ..utils import misc
 from . import interfaces
+from . import phones
+from . import principals
 
 class Database:
     def __init__(
             self,
-            storage_type: str = "json"
+            storage_type: str = "json",
+            options: Optional[dict] = None
         ) -> None:
         """
         Constructs a Database object.
@@ -17,15 +26,62 @@ class Database:
         Arguments:
             storage_type (str): Storage type to use
                 Can be anything in api.classes.interfaces.
+            options (dict): Keyword arguments passed to the interface.
+                Ones it doesn't take are ignored, so switching
+                storage types doesn't mean rewriting them.
         """
         self.storage_type = storage_type
 
         if storage_type in interfaces.interfaces:
-            self.interface = interfaces.interfaces[storage_type](self)
+            interface = interfaces.interfaces[storage_type]
+            accepted = inspect.signature(interface).parameters
+
+            options = options or {}
+            ignored = [x for x in options if x not in accepted]
+
+            if ignored:
+                logger.log("warn", "Ignoring storage options", storage_type = storage_type, options = ignored)
+
+            self.interface = interface(self, **{x: y for x, y in options.items() if x in accepted})
 
         else:
             raise exceptions.InvalidInterface()
 
+        self.principals = principals.PrincipalCache(self)
+        self.phone_index = phones.PhoneIndex(self)
+
+        # Versions only live in memory, so they're paired with
+        # an epoch that's new every time the database is created
+        self.epoch = uuid.uuid4().hex[:8]
+        self.clock = 0
+
+        # path -> version of the last write at or below it
+        self.versions = {}
+
+        # path -> version of the last write exactly to it
+        self.replaced = {}
+
+        # path -> version of the last write at or below it that
+        # changed more than volatile fields
+        self.stable = {}
+
+        # Fields that change with nearly every write, by collection
+        self.volatile = {"devices": {"data"}}
+
+        # Collections nothing outside the write path has seen since
+        # they were copied, so writes can change them in place.
+        # Anything handing a collection out must share() it first.
+        self.owned = {}
+
+        # Whether other processes write to the same storage
+        self.shared = getattr(self.interface, "shared", False)
+
+        # Coroutine functions called with (path, old, new)
+        # for every change another process made
+        self.listeners = []
+
+        self.task = None
+
     async def load(
             self
         ) -> None:
@@ -35,12 +91,278 @@ class Database:
 
         await self.interface.load()
 
+        # From here on, the tree is only ever replaced, never modified
+        self.interface.data = misc.freeze(self.interface.data)
+
         # Check that everything's there
         for key, default in api.config.db.items():
             if key not in self.interface.data:
-                self.interface.data[key] = default
+                await self.put(
+                    key,
+                    copy.deepcopy(default)
+                )
+
+        self.principals.invalidate()
+        self.phone_index.invalidate()
+
+        await self.flush()
+
+    def touch(
+            self,
+            path: str,
+            volatile: bool = False
+        ) -> None:
+        """
+        Gives path a new version, along with everything above it.
 
-        await self.write()
+        Arguments:
+            path (str): Path that was written
+            volatile (bool): Whether only volatile fields changed,
+                in which case stable versions are left alone
+        """
+
+        self.clock += 1
+        self.replaced[path] = self.clock
+
+        parts = path.split("/")
+
+        for i in range(1, len(parts) + 1):
+            self.versions["/".join(parts[:i])] = self.clock
+
+            if not volatile:
+                self.stable["/".join(parts[:i])] = self.clock
+
+    def is_volatile(
+            self,
+            path: str,
+            old,
+            new
+        ) -> bool:
+        """
+        Checks if a write only changes volatile fields,
+        like a device's readings.
+
+        Arguments:
+            path (str): Path being written
+            old: Value at path before the write, or None
+            new: Value being stored at path, or None
+        """
+
+        collection, *rest = path.split("/")
+        fields = self.volatile.get(collection)
+
+        if not fields or not rest:
+            return False
+
+        if len(rest) > 1:
+            return rest[1] in fields
+
+        if old is None or new is None or old.keys() != new.keys():
+            return False
+
+        return all(old[x] == new[x] for x in old if x not in fields)
+
+    def lookup(
+            self,
+            path: str
+        ):
+        """
+        Gets the current value at path, or None.
+        """
+
+        try:
+            return misc.follow(self.interface.data, path)
+
+        except (exceptions.NotFound, TypeError):
+            return None
+
+    def share(
+            self,
+            collection: Optional[str] = None
+        ) -> None:
+        """
+        Marks a collection, or the whole tree, as handed out,
+        so writes copy it again instead of changing it in
+        place. Must be called before anything keeps a
+        collection past the current write, or reads it
+        off the event loop.
+
+        Arguments:
+            collection (str): Collection to share, or None for all
+        """
+
+        if collection is None:
+            self.owned.clear()
+
+        else:
+            self.owned.pop(collection, None)
+
+    def version(
+            self,
+            path: str,
+            stable: bool = False
+        ) -> int:
+        """
+        Gets the version of path. It increases whenever
+        anything at, below or replacing path is written.
+
+        Arguments:
+            path (str): Path to check
+            stable (bool): Ignore writes that only changed
+                volatile fields, for responses that leave
+                them out
+
+        Returns:
+            int, 0 if it hasn't been written since loading
+        """
+
+        parts = path.split("/")
+
+        version = (self.stable if stable else self.versions).get(path, 0)
+
+        # Writes to a parent replace everything below it
+        for i in range(1, len(parts)):
+            version = max(version, self.replaced.get("/".join(parts[:i]), 0))
+
+        return version
+
+    def listen(
+            self,
+            listener
+        ) -> None:
+        """
+        Registers a listener for changes made by other
+        processes, in shared mode. Anything that caches
+        data from the database should listen, since those
+        changes don't go through put().
+
+        Arguments:
+            listener: Coroutine function, awaited with the
+                changed path, its old value and its new value.
+                Either value is None if the path didn't exist.
+        """
+
+        self.listeners.append(listener)
+
+    def start(
+            self
+        ) -> None:
+        """
+        Starts following changes made by other processes,
+        in shared mode. Must be called from the serving
+        event loop.
+        """
+
+        if self.shared:
+            self.task = asyncio.get_running_loop().create_task(self.loop())
+
+    async def loop(
+            self
+        ) -> None:
+        while True:
+            await asyncio.sleep(self.interface.poll_interval)
+
+            try:
+                await self.sync()
+
+            except Exception as e:
+                logger.log("error", "Polling for changes failed", error = str(e))
+
+    async def sync(
+            self
+        ) -> None:
+        """
+        Applies changes made by other processes since the
+        last call, then notifies caches and listeners.
+        """
+
+        clock = self.clock
+
+        put, deleted = await self.interface.poll()
+
+        # Anything written here while polling is newer than
+        # what was read, and will reach the storage after it
+        changes = {
+            path: misc.freeze(value) for path, value in put.items()
+            if self.version(path) <= clock
+        }
+        deleted = [path for path in deleted if self.version(path) <= clock]
+
+        if not changes and not deleted:
+            return
+
+        # Collections may be changed in place, so look first
+        previous = {path: self.lookup(path) for path in [*deleted, *changes]}
+
+        data = self.interface.data
+
+        for path in deleted:
+            try:
+                data = misc.without(data, path, self.owned)
+
+            except exceptions.NotFound:
+                pass
+
+        for path, value in changes.items():
+            collection, *rest = path.split("/")
+
+            # Collections created elsewhere
+            if rest and collection not in data:
+                data = misc.replace(data, {collection: misc.FrozenDict()}, self.owned)
+
+            data = misc.replace(data, {path: value}, self.owned)
+
+        self.interface.data = data
+
+        for path in previous:
+            self.touch(path, self.is_volatile(path, previous[path], changes.get(path)))
+
+        # Readings and usage flushes come through here all the
+        # time, and must not rebuild every principal
+        collections = {path.split("/", 1)[0] for path in previous}
+
+        if "keys" in collections or any(
+            self.changes_access(path, previous[path], changes.get(path))
+            for path in previous
+        ):
+            self.principals.invalidate()
+
+        if "phones" in collections:
+            self.phone_index.invalidate()
+
+        for path in previous:
+            for listener in self.listeners:
+                await listener(path, previous[path], changes.get(path))
+
+    def changes_access(
+            self,
+            path: str,
+            old,
+            new
+        ) -> bool:
+        """
+        Checks if a change to a node or device can change
+        which keys have access to it.
+
+        Arguments:
+            path (str): Path that changed
+            old: Value before the change, or None
+            new: Value after the change, or None if deleted
+        """
+
+        collection, *rest = path.split("/")
+
+        if collection not in ["nodes", "devices"]:
+            return False
+
+        if len(rest) != 1:
+            # The whole collection, or a field inside an entity
+            return not rest or rest[1] == "keys"
+
+        old_keys = None if old is None else old.get("keys")
+        new_keys = None if new is None else new.get("keys")
+
+        return old_keys != new_keys
 
     async def get(
             self,
@@ -49,11 +371,17 @@ class Database:
         """
         Gets data from the database.
 
-        Path is a Unix-like path.
+        Path is a Unix-like path. What's returned is an
+        immutable snapshot, which later writes won't change.
+        Use misc.thaw() to get a copy that can be edited.
         
         Arguments:
             path (str): Path to follow
         """
+        # Whoever gets a whole collection may keep it
+        if path in self.owned:
+            self.share(path)
+
         return misc.follow(self.interface.data, path)
 
     async def put(
@@ -64,21 +392,133 @@ class Database:
         """
         Stores data back into the database.
 
-        Overwrites the specified path with new.
+        Overwrites the specified path with new. A frozen
+        copy of new is stored, so later changes to it by
+        the caller don't leak into the database.
 
         Arguments:
             path (str): Path to follow
             new: Data to set that path to
         """
-        comp = []
         for name in path.split("/"):
             if "'" in name or '"' in name:
                 raise exceptions.SecurityError("Blocked attempted string exit")
 
-            comp.append(f"['{name}']")
+        start = time.perf_counter()
 
-        exec(f"self.interface.data{''.join(comp)} = new")
-        await self.interface.write()
+        new = misc.freeze(new)
+        volatile = self.is_volatile(path, self.lookup(path), new)
+
+        self.interface.data = misc.replace(self.interface.data, {path: new}, self.owned)
+        self.touch(path, volatile)
+
+        await self.interface.update(path, new)
+
+        metrics.db_put_seconds.observe(time.perf_counter() - start, "put")
+
+    async def put_many(
+            self,
+            changes: dict
+        ) -> None:
+        """
+        Stores several paths at once, with a single write.
+
+        Arguments:
+            changes (dict): New data, keyed by path
+        """
+        for path in changes:
+            for name in path.split("/"):
+                if "'" in name or '"' in name:
+                    raise exceptions.SecurityError("Blocked attempted string exit")
+
+        start = time.perf_counter()
+
+        changes = {path: misc.freeze(new) for path, new in changes.items()}
+        volatile = {path: self.is_volatile(path, self.lookup(path), new) for path, new in changes.items()}
+
+        # Swapped in all at once, so readers never see half a batch
+        self.interface.data = misc.replace(self.interface.data, changes, self.owned)
+
+        for path in changes:
+            self.touch(path, volatile[path])
+
+        await self.interface.update_many(changes)
+
+        metrics.db_put_seconds.observe(time.perf_counter() - start, "put_many")
+
+    async def modify_many(
+            self,
+            changes: dict
+        ) -> dict:
+        """
+        Reads, changes and writes back several entries
+        at once. In shared mode this is atomic against
+        other processes, which makes it the way to update
+        anything they might change too, like counters.
+
+        Arguments:
+            changes (dict): Functions, keyed by entry path
+                (collection/uuid). Each is called with the
+                current entry, or None if there isn't one, and
+                returns the new entry, or None to leave it be.
+
+        Returns:
+            dict of new entries, keyed by path
+        """
+        if not self.shared:
+            current = {}
+
+            for path, function in changes.items():
+                try:
+                    current[path] = function(misc.follow(self.interface.data, path))
+
+                except exceptions.NotFound:
+                    current[path] = function(None)
+
+            changes = {path: new for path, new in current.items() if new is not None}
+
+            if changes:
+                await self.put_many(changes)
+
+            return changes
+
+        start = time.perf_counter()
+
+        # Already written, so only memory needs to catch up
+        changes = {
+            path: misc.freeze(new)
+            for path, new in (await self.interface.modify(changes)).items()
+        }
+
+        if changes:
+            volatile = {path: self.is_volatile(path, self.lookup(path), new) for path, new in changes.items()}
+            self.interface.data = misc.replace(self.interface.data, changes, self.owned)
+
+            for path in changes:
+                self.touch(path, volatile[path])
+
+        metrics.db_put_seconds.observe(time.perf_counter() - start, "modify_many")
+
+        return changes
+
+    async def delete(
+            self,
+            path: str
+        ) -> None:
+        """
+        Deletes data from the database.
+
+        Arguments:
+            path (str): Path to delete
+        """
+        start = time.perf_counter()
+
+        self.interface.data = misc.without(self.interface.data, path, self.owned)
+        self.touch(path)
+
+        await self.interface.remove(path)
+
+        metrics.db_put_seconds.observe(time.perf_counter() - start, "delete")
 
     async def write(
             self
@@ -86,4 +526,25 @@ class Database:
         """
         Tells the interface to write the database.
         """
-        await self.interface.write()
\ No newline at end of file
+        await self.interface.write()
+
+    async def flush(
+            self
+        ):
+        """
+        Tells the interface to write everything to disk
+        immediately, skipping any write-behind window.
+        """
+        await self.interface.flush()
+
+    async def close(
+            self
+        ):
+        """
+        Flushes pending writes. Should be called on shutdown.
+        """
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+        await self.interface.close()
\ No newline at end of file
@@ -0,0 +1,269 @@
+import operator
+
+from ..utils import logger
+
+comparisons = {
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+    "==": operator.eq,
+    "!=": operator.ne
+}
+
+# Spelled-out names, which were accepted before comparisons
+# were validated and may still be stored on devices
+aliases = {
+    "gt": ">", "greater": ">", "greater_than": ">",
+    "ge": ">=", "greater_equal": ">=", "greater_or_equal": ">=",
+    "lt": "<", "less": "<", "less_than": "<",
+    "le": "<=", "less_equal": "<=", "less_or_equal": "<=",
+    "eq": "==", "equal": "==", "equals": "==",
+    "ne": "!=", "not_equal": "!=", "not_equals": "!="
+}
+
+class Rule:
+    def __init__(
+            self,
+            device_uuid: str,
+            name: str,
+            details: dict
+        ) -> None:
+        """
+        Constructs a Rule object.
+
+        A rule is one compiled device event. Fault events
+        compare their value against the threshold with their
+        comparison, and trigger events fire when their value
+        equals the threshold.
+
+        Rules only fire on the reading where they start
+        matching, not on every reading while they match.
+
+        Parameters:
+            device_uuid (str): Device the event belongs to
+            name (str): Name of the event
+            details (dict): Event details, as stored on the device
+        """
+
+        self.device = device_uuid
+        self.name = name
+        self.details = details
+        self.type = details["type"]
+        self.value = details["value"]
+        self.threshold = details["threshold"]
+
+        if self.type == "fault":
+            comparison = details["comparison"]
+            comparison = aliases.get(str(comparison).lower(), comparison)
+
+            if comparison not in comparisons:
+                raise ValueError(f"Unknown comparison {comparison}")
+
+            self.compare = comparisons[comparison]
+            self.on_trigger = None
+
+        else:
+            self.compare = operator.eq
+            self.on_trigger = details["on_trigger"]
+
+        self.active = False
+
+    def evaluate(
+            self,
+            value
+        ) -> bool:
+        """
+        Checks a new reading against the rule.
+
+        Returns:
+            True if the rule just started matching
+        """
+
+        try:
+            matched = value is not None and bool(self.compare(value, self.threshold))
+
+        except TypeError:
+            matched = False
+
+        fired = matched and not self.active
+        self.active = matched
+
+        return fired
+
+class EventEngine:
+    def __init__(
+            self
+        ) -> None:
+        """
+        Constructs an EventEngine object.
+
+        Device events are compiled into rules when they're
+        saved, and indexed by device and data key. Evaluating
+        a reading only looks at rules for the keys that
+        changed, so its cost doesn't depend on how many
+        devices or events are configured.
+        """
+
+        # device uuid -> data key -> [Rule]
+        self.rules = {}
+
+        # event type -> [handler(device, rule, value)]
+        self.handlers = {}
+
+    async def load(
+            self,
+            db
+        ) -> None:
+        """
+        Compiles the events of every device in a database.
+        """
+
+        self.rules = {}
+
+        for device in (await db.get("devices")).values():
+            self.compile(device)
+
+    def compile(
+            self,
+            device: dict
+        ) -> None:
+        """
+        Compiles (or recompiles) a device's events.
+        """
+
+        # Rules that didn't change keep whether they're matching,
+        # so recompiling doesn't make them fire again
+        previous = {
+            rule.name: rule
+            for rules in self.rules.get(device["uuid"], {}).values()
+            for rule in rules
+        }
+
+        index = {}
+
+        for name, details in device.get("events", {}).items():
+            # One broken event shouldn't stop the rest from running
+            try:
+                rule = Rule(device["uuid"], name, details)
+
+            except (KeyError, TypeError, ValueError) as e:
+                logger.log("warn", "Skipping invalid event", device = device["uuid"], event = name, error = repr(e))
+                continue
+
+            if name in previous and previous[name].details == details:
+                rule.active = previous[name].active
+
+            index.setdefault(rule.value, []).append(rule)
+
+        if index:
+            self.rules[device["uuid"]] = index
+
+        else:
+            self.rules.pop(device["uuid"], None)
+
+    def remove(
+            self,
+            device_uuid: str
+        ) -> None:
+        """
+        Drops all rules for a device.
+        """
+
+        self.rules.pop(device_uuid, None)
+
+    async def changed(
+            self,
+            path: str,
+            old,
+            new
+        ) -> None:
+        """
+        Database listener. Recompiles the events of devices
+        that another process changed, when their events did.
+        """
+
+        collection, *rest = path.split("/")
+
+        if collection != "devices":
+            return
+
+        if not rest:
+            self.rules = {}
+
+            for device in (new or {}).values():
+                self.compile(device)
+
+        elif new is None:
+            self.remove(rest[0])
+
+        elif old is None or old.get("events") != new.get("events"):
+            self.compile(new)
+
+    def register(
+            self,
+            event_type: str,
+            handler
+        ) -> None:
+        """
+        Registers a handler to call when an event
+        of some type fires.
+
+        Arguments:
+            event_type (str): "fault" or "trigger"
+            handler: Coroutine function, awaited with
+                (device, rule, value). Must not block.
+        """
+
+        self.handlers.setdefault(event_type, []).append(handler)
+
+    async def evaluate(
+            self,
+            device: dict,
+            previous: dict,
+            current: dict,
+            notify: bool = True
+        ) -> list:
+        """
+        Runs the rules for every data key that changed,
+        and calls handlers for the ones that fired.
+
+        Arguments:
+            device (dict): Device that was updated
+            previous (dict): Device data before the update
+            current (dict): New data keys and values
+            notify (bool): Whether to call handlers. Readings
+                another process already handled only update
+                which rules are matching.
+
+        Returns:
+            list of Rules that fired
+        """
+
+        index = self.rules.get(device["uuid"])
+
+        if index is None:
+            return []
+
+        fired = []
+
+        for key, value in current.items():
+            rules = index.get(key)
+
+            if rules is None or (key in previous and previous[key] == value):
+                continue
+
+            for rule in rules:
+                if rule.evaluate(value) and notify:
+                    fired.append(rule)
+
+                    for handler in self.handlers.get(rule.type, []):
+                        # The reading is already stored, so a failing
+                        # handler mustn't fail the request with it
+                        try:
+                            await handler(device, rule, value)
+
+                        except Exception as e:
+                            logger.log("error", "Event handler failed", device = device["uuid"], event = rule.name, error = repr(e))
+
+        return fired
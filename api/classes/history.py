@@ -0,0 +1,339 @@
+from array import array
+from typing import Optional
+
+class RingBuffer:
+    def __init__(
+            self,
+            capacity: int,
+            columns: int = 1
+        ) -> None:
+        """
+        Constructs a RingBuffer object.
+
+        Holds the most recent capacity rows of one device
+        data key in arrays of doubles, one for the timestamp
+        and one per column. The arrays start small and double
+        as rows arrive, so a buffer only takes capacity *
+        sample_size bytes once it has been filled.
+
+        Parameters:
+            capacity (int): Maximum rows to retain
+            columns (int): Values stored per row
+        """
+
+        self.capacity = capacity
+        self.sample_size = 8 * (columns + 1)
+
+        self.allocated = min(capacity, 16)
+
+        self.timestamps = array("d", bytes(8 * self.allocated))
+        self.columns = [array("d", bytes(8 * self.allocated)) for i in range(columns)]
+
+        self.start = 0
+        self.size = 0
+
+        self.boolean = False
+
+    def __len__(self) -> int:
+        return self.size
+
+    def index(
+            self,
+            i: int
+        ) -> int:
+        """
+        Maps a logical index (0 is the oldest row)
+        to its position in the arrays.
+        """
+
+        return (self.start + i) % self.capacity
+
+    def grow(self) -> None:
+        """
+        Doubles the arrays, up to capacity. Only called
+        before the buffer first fills up, while rows are
+        still in order from position 0.
+        """
+
+        extra = min(self.capacity, self.allocated * 2) - self.allocated
+
+        for column in [self.timestamps, *self.columns]:
+            column.frombytes(bytes(8 * extra))
+
+        self.allocated += extra
+
+    def last(self) -> int:
+        """
+        Gets the array position of the newest row.
+        """
+
+        return self.index(self.size - 1)
+
+    def append(
+            self,
+            timestamp: float,
+            *values
+        ) -> None:
+        """
+        Adds a row, dropping the oldest one if full.
+
+        Timestamps must not go backwards, so an earlier
+        one is clamped to the latest row's.
+        """
+
+        if self.size:
+            timestamp = max(timestamp, self.timestamps[self.last()])
+
+        else:
+            self.boolean = isinstance(values[0], bool)
+
+        if self.size < self.capacity:
+            if self.size == self.allocated:
+                self.grow()
+
+            i = self.index(self.size)
+            self.size += 1
+
+        else:
+            i = self.start
+            self.start = (self.start + 1) % self.capacity
+
+        self.timestamps[i] = timestamp
+
+        for column, value in zip(self.columns, values):
+            column[i] = value
+
+    def bisect(
+            self,
+            timestamp: float,
+            right: bool = False
+        ) -> int:
+        """
+        Binary searches for the logical index where a
+        row at timestamp would be inserted.
+
+        Arguments:
+            timestamp (float): Timestamp to search for
+            right (bool): Insert after equal timestamps
+                instead of before
+        """
+
+        low, high = 0, self.size
+
+        while low < high:
+            mid = (low + high) // 2
+            current = self.timestamps[self.index(mid)]
+
+            if current < timestamp or (right and current == timestamp):
+                low = mid + 1
+
+            else:
+                high = mid
+
+        return low
+
+    def row(
+            self,
+            i: int
+        ) -> list:
+        """
+        Formats the row at an array position for output.
+        """
+
+        value = self.columns[0][i]
+
+        return [self.timestamps[i], bool(value) if self.boolean else value]
+
+    def range(
+            self,
+            start: Optional[float] = None,
+            end: Optional[float] = None
+        ) -> list:
+        """
+        Gets every row with start <= timestamp <= end,
+        oldest first.
+        """
+
+        first = 0 if start is None else self.bisect(start)
+        last = self.size if end is None else self.bisect(end, True)
+
+        return [self.row(self.index(i)) for i in range(first, last)]
+
+class RollupBuffer(RingBuffer):
+    def __init__(
+            self,
+            capacity: int,
+            width: int
+        ) -> None:
+        """
+        Constructs a RollupBuffer object.
+
+        Each row is one bucket of width seconds, holding
+        the min, max, sum and count of every sample that
+        fell into it. Buckets are updated in place as
+        samples arrive, so reads never aggregate raw data.
+
+        Parameters:
+            capacity (int): Maximum buckets to retain
+            width (int): Seconds covered by each bucket
+        """
+
+        super().__init__(capacity, 4)
+
+        self.width = width
+
+    def add(
+            self,
+            timestamp: float,
+            value
+        ) -> None:
+        """
+        Folds a sample into its bucket.
+        """
+
+        bucket = timestamp - timestamp % self.width
+
+        if not self.size or self.timestamps[self.last()] < bucket:
+            self.append(bucket, value, value, value, 1)
+            return
+
+        # Clamped to the newest bucket if the clock went backwards
+        i = self.last()
+        minimum, maximum, total, count = self.columns
+
+        minimum[i] = min(minimum[i], value)
+        maximum[i] = max(maximum[i], value)
+        total[i] += value
+        count[i] += 1
+
+    def row(
+            self,
+            i: int
+        ) -> list:
+        minimum, maximum, total, count = self.columns
+
+        return [self.timestamps[i], minimum[i], maximum[i], total[i] / count[i], int(count[i])]
+
+    def range(
+            self,
+            start: Optional[float] = None,
+            end: Optional[float] = None
+        ) -> list:
+        """
+        Gets every bucket overlapping start <= timestamp <= end,
+        oldest first, as [bucket_start, min, max, mean, count].
+        """
+
+        if start is not None:
+            # Include the bucket start falls inside
+            start = start - start % self.width
+
+        return super().range(start, end)
+
+class HistoryStore:
+    def __init__(
+            self,
+            capacity: int = 1440,
+            tiers: Optional[dict] = None
+        ) -> None:
+        """
+        Constructs a HistoryStore object.
+
+        Keeps a raw RingBuffer for every device and numeric
+        or boolean data key, and one RollupBuffer per tier
+        for the numeric ones, since min/max/mean mean nothing
+        for booleans. Buffers grow as samples arrive, up to
+        capacity * 16 bytes for raw samples plus capacity * 40
+        bytes for each tier per key.
+
+        Parameters:
+            capacity (int): Raw samples to retain per device data key
+            tiers (dict): Rollup tiers by resolution name, each
+                with a bucket width (seconds) and a capacity
+        """
+
+        self.capacity = capacity
+        self.tiers = tiers or {}
+
+        self.buffers = {}
+
+    @property
+    def resolutions(self) -> list:
+        return ["raw", *self.tiers]
+
+    def record(
+            self,
+            device_uuid: str,
+            data: dict,
+            timestamp: float
+        ) -> None:
+        """
+        Records every numeric or boolean value in a
+        device data update.
+
+        Arguments:
+            device_uuid (str): Device the data came from
+            data (dict): Data keys and their new values
+            timestamp (float): When the data was received
+        """
+
+        buffers = self.buffers.setdefault(device_uuid, {})
+
+        for key, value in data.items():
+            if not isinstance(value, (bool, int, float)):
+                continue
+
+            series = buffers.get(key)
+
+            if series is None:
+                series = buffers[key] = {"raw": RingBuffer(self.capacity)}
+
+                if not isinstance(value, bool):
+                    series.update({
+                        name: RollupBuffer(tier["capacity"], tier["width"])
+                        for name, tier in self.tiers.items()
+                    })
+
+            for resolution, buffer in series.items():
+                if resolution == "raw":
+                    buffer.append(timestamp, value)
+
+                else:
+                    buffer.add(timestamp, value)
+
+    def query(
+            self,
+            device_uuid: str,
+            key: str,
+            start: Optional[float] = None,
+            end: Optional[float] = None,
+            resolution: str = "raw"
+        ) -> list:
+        """
+        Gets a device data key's history within a time range.
+
+        Arguments:
+            device_uuid (str): Device to read
+            key (str): Data key to read
+            start (float): Earliest timestamp, or None for all
+            end (float): Latest timestamp, or None for all
+            resolution (str): "raw", or the name of a rollup tier.
+                Boolean keys only have raw history.
+        """
+
+        buffer = self.buffers.get(device_uuid, {}).get(key, {}).get(resolution)
+
+        if buffer is None:
+            return []
+
+        return buffer.range(start, end)
+
+    def remove(
+            self,
+            device_uuid: str
+        ) -> None:
+        """
+        Drops all history for a device.
+        """
+
+        self.buffers.pop(device_uuid, None)
@@ -1,38 +1,78 @@
+import asyncio
+import concurrent.futures
 import os
+import re
+import shutil
+import sqlite3
+import time
+import uuid
 import aiofiles
-import json
 import copy
 from typing import Optional
 
 import api
+from ..utils import codec
+from ..utils import exceptions
+from ..utils import logger
+from ..utils import metrics
+from ..utils import misc
 from ..utils import subprocess
+from . import backups
 
 class JSONInterface:
     def __init__(
             self,
             parent,
-            path: str = "db"
-
+            path: str = "db",
+            write_behind: bool = False,
+            flush_interval: float = 0.25,
+            flush_ops: int = 100,
+            compact: bool = False
         ) -> None:
         """
         Constructs a JSON interface.
 
         Interfaces are what the DB uses to store
         all its data. Similar ones can be written for
-        almost any storage type, if they have load()
-        and write() methods.
+        almost any storage type, if they have load(),
+        write(), update(), remove(), flush() and close()
+        methods.
 
         Parameters:
             parent (Database) - Parent database that's
                 using this interface
             path (str) - Folder name for database files. 
+            write_behind (bool) - If True, writes only mark the
+                database dirty, and are coalesced into a single
+                flush after flush_interval seconds or flush_ops
+                writes, whichever comes first.
+            flush_interval (float) - Seconds to wait before flushing
+                in write-behind mode
+            flush_ops (int) - Writes to coalesce before flushing
+                immediately in write-behind mode
+            compact (bool) - If True, db.json is written without
+                indentation. Smaller and faster, but not as easy
+                to read by hand.
         """
 
+        self.parent = parent
         self.path = path
 
         self.data = None
 
-        self.lock = False
+        # Flushes take turns, and skip a snapshot that's already on disk
+        self.lock = asyncio.Lock()
+        self.flushed = None
+
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self.flush_ops = flush_ops
+
+        self.dirty = False
+        self.pending_ops = 0
+        self.flush_task = None
+
+        self.compact = compact
 
     async def load(
             self
@@ -53,36 +93,1432 @@ class JSONInterface:
         # Read it
         try:
             async with aiofiles.open(f"{self.path}/db.json", mode = "r") as f:
-                self.data = json.loads(await f.read())
+                self.data = codec.loads(await f.read())
 
-        except:
-            # Generate it again
-            async with aiofiles.open(f"{self.path}/db.json", mode = "w+") as f:
-                self.data = copy.copy(api.config.db)
+        except FileNotFoundError:
+            # Generate it
+            self.data = copy.copy(api.config.db)
+            await self.flush()
+
+        except ValueError:
+            # Keep the broken file around, and fall back to the last backup
+            logger.log("error", "Database is corrupt, restoring the last backup", path = self.path)
+            os.replace(f"{self.path}/db.json", f"{self.path}/db.json.corrupt")
 
-                self.lock = False
-                await self.write()
+            try:
+                self.data = backups.restore(f"{self.path}/backups")
+
+            except (exceptions.NotFound, OSError):
+                self.data = copy.copy(api.config.db)
 
-        self.lock = False
+            await self.flush()
 
     async def write(
             self
         ) -> None:
         """
         Writes all active data to the database.
+
+        In write-behind mode, this only schedules a flush.
+        """
+
+        if not self.write_behind:
+            await self.flush()
+            return
+
+        self.dirty = True
+        self.pending_ops += 1
+
+        if self.pending_ops >= self.flush_ops:
+            await self.flush()
+
+        elif self.flush_task is None:
+            self.flush_task = asyncio.get_running_loop().create_task(self.delayed_flush())
+
+    async def update(
+            self,
+            path: str,
+            new
+        ) -> None:
+        """
+        Called after the database stores new at path.
+        The JSON interface always writes the whole file.
+        """
+
+        await self.write()
+
+    async def update_many(
+            self,
+            changes: dict
+        ) -> None:
+        """
+        Called after the database stores several paths at once.
+        """
+
+        await self.write()
+
+    async def remove(
+            self,
+            path: str
+        ) -> None:
+        """
+        Called after the database deletes path.
+        """
+
+        await self.write()
+
+    async def delayed_flush(
+            self
+        ) -> None:
+        """
+        Waits out the write-behind window, then flushes.
+        """
+
+        await asyncio.sleep(self.flush_interval)
+
+        self.flush_task = None
+
+        if self.dirty:
+            await self.flush()
+
+    async def flush(
+            self
+        ) -> None:
+        """
+        Writes all active data to disk right away.
+
+        The file is replaced atomically, so a crash mid-write
+        can't truncate it. Concurrent flushes wait their turn,
+        then write whatever is newest by then.
+        """
+
+        async with self.lock:
+            self.parent.share()
+            data = self.data
+
+            self.dirty = False
+            self.pending_ops = 0
+
+            # A flush that held the lock already wrote this
+            if data is self.flushed:
+                return
+
+            start = time.perf_counter()
+
+            # Snapshots are immutable, so this is safe off the loop
+            written = await asyncio.get_running_loop().run_in_executor(
+                None,
+                self.sync_flush,
+                data
+            )
+
+            self.flushed = data
+
+            metrics.db_write_seconds.observe(time.perf_counter() - start, "json")
+            metrics.db_bytes_written.inc(written, "json")
+
+    def sync_flush(
+            self,
+            data: dict
+        ) -> int:
+        return misc.atomic_write(
+            f"{self.path}/db.json",
+            codec.dumps(data, pretty = not self.compact)
+        )
+
+    async def close(
+            self
+        ) -> None:
+        """
+        Flushes anything still pending. Should be
+        called on shutdown.
+        """
+
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+
+        if self.dirty:
+            await self.flush()
+
+class JournalInterface:
+    def __init__(
+            self,
+            parent,
+            path: str = "db",
+            compact_ops: int = 1000
+        ) -> None:
+        """
+        Constructs a journal interface.
+
+        Every put or delete is appended to a journal as
+        one compact JSON line, so a write only costs the
+        size of the change. The journal is replayed on top
+        of the last snapshot when loading, and folded into
+        a new snapshot in the background once it grows past
+        compact_ops records.
+
+        Parameters:
+            parent (Database) - Parent database that's
+                using this interface
+            path (str) - Folder name for database files.
+            compact_ops (int) - Journal records to allow
+                before compacting into a new snapshot
+        """
+
+        self.parent = parent
+        self.path = path
+        self.compact_ops = compact_ops
+
+        self.data = None
+
+        self.journal = None
+        self.journal_ops = 0
+
+        self.append_lock = asyncio.Lock()
+        self.compact_task = None
+
+    @property
+    def snapshot_path(self) -> str:
+        return f"{self.path}/snapshot.json"
+
+    @property
+    def journal_path(self) -> str:
+        return f"{self.path}/journal.log"
+
+    async def load(
+            self
+        ) -> None:
+        """
+        Reads the last snapshot, then replays any journals
+        written since on top of it.
+        """
+
+        os.makedirs(f"{self.path}/backups", exist_ok = True)
+
+        journals = [f"{self.journal_path}.old", self.journal_path]
+
+        try:
+            async with aiofiles.open(self.snapshot_path, mode = "r") as f:
+                self.data = codec.loads(await f.read())
+
+        except FileNotFoundError:
+            if any(os.path.exists(x) for x in journals):
+                self.data = copy.deepcopy(api.config.db)
+
+            else:
+                await self.migrate()
+
+        except ValueError:
+            # Keep the broken snapshot around, and fall back to the last
+            # backup. The journals still hold everything written since.
+            logger.log("error", "Snapshot is corrupt, restoring the last backup", path = self.path)
+            os.replace(self.snapshot_path, f"{self.snapshot_path}.corrupt")
+
+            try:
+                self.data = backups.restore(f"{self.path}/backups")
+
+            except (exceptions.NotFound, OSError):
+                self.data = copy.deepcopy(api.config.db)
+
+        # A leftover rotated journal means we crashed mid-compaction.
+        # Replaying it again is harmless, since records are absolute.
+        for journal_path in journals:
+            if os.path.exists(journal_path):
+                await self.replay(journal_path)
+
+    async def migrate(
+            self
+        ) -> None:
+        """
+        Starts a new journal, importing db.json from the
+        JSON interface if there is one.
+        """
+
+        try:
+            async with aiofiles.open(f"{self.path}/db.json", mode = "r") as f:
+                self.data = codec.loads(await f.read())
+
+        except FileNotFoundError:
+            self.data = copy.deepcopy(api.config.db)
+            return
+
+        logger.log("info", "Imported db.json into a new journal", path = self.path)
+
+        await self.compact()
+
+    async def replay(
+            self,
+            journal_path: str
+        ) -> None:
+        """
+        Applies every record in a journal file to self.data.
+
+        Parameters:
+            journal_path (str) - Journal file to replay
+        """
+
+        async with aiofiles.open(journal_path, mode = "r") as f:
+            async for line in f:
+                try:
+                    record = codec.loads(line)
+
+                except ValueError:
+                    # Torn final line from a crash mid-append
+                    continue
+
+                try:
+                    if record["op"] == "put":
+                        misc.assign(self.data, record["path"], record["value"])
+
+                    elif record["op"] == "delete":
+                        misc.remove(self.data, record["path"])
+
+                except (KeyError, TypeError, exceptions.NotFound):
+                    continue
+
+                self.journal_ops += 1
+
+    async def append(
+            self,
+            *records
+        ) -> None:
+        """
+        Appends records to the journal in a single write, and
+        starts a compaction in the background if it's grown
+        too long.
+
+        Parameters:
+            records (dict) - Records to append
+        """
+
+        start = time.perf_counter()
+        line = "".join(codec.dumps(record) + "\n" for record in records)
+
+        async with self.append_lock:
+            if self.journal is None:
+                self.journal = await aiofiles.open(self.journal_path, mode = "a")
+
+            await self.journal.write(line)
+            await self.journal.flush()
+
+        metrics.db_write_seconds.observe(time.perf_counter() - start, "journal")
+        metrics.db_bytes_written.inc(len(line), "journal")
+
+        self.journal_ops += len(records)
+
+        if self.journal_ops >= self.compact_ops and self.compact_task is None:
+            self.compact_task = asyncio.get_running_loop().create_task(self.compact())
+
+    async def update(
+            self,
+            path: str,
+            new
+        ) -> None:
+        """
+        Records that new was stored at path.
+        """
+
+        await self.append(
+            {
+                "op": "put",
+                "path": path,
+                "value": new
+            }
+        )
+
+    async def update_many(
+            self,
+            changes: dict
+        ) -> None:
+        """
+        Records that several paths were stored at once.
+        """
+
+        await self.append(
+            *[
+                {
+                    "op": "put",
+                    "path": path,
+                    "value": new
+                } for path, new in changes.items()
+            ]
+        )
+
+    async def remove(
+            self,
+            path: str
+        ) -> None:
+        """
+        Records that path was deleted.
+        """
+
+        await self.append(
+            {
+                "op": "delete",
+                "path": path
+            }
+        )
+
+    async def compact(
+            self
+        ) -> None:
+        """
+        Writes a new snapshot and drops the journal it replaces.
+        """
+
+        loop = asyncio.get_running_loop()
+
+        try:
+            async with self.append_lock:
+                # Take the data and rotate together, so every record
+                # in the new journal comes after the snapshot
+                self.parent.share()
+                data = self.data
+
+                if self.journal is not None:
+                    await self.journal.close()
+                    self.journal = None
+
+                if os.path.exists(self.journal_path):
+                    await loop.run_in_executor(None, self.sync_rotate)
+
+                self.journal_ops = 0
+
+            # Snapshots are immutable, so this is safe off the loop
+            written = await loop.run_in_executor(
+                None,
+                self.sync_snapshot,
+                data
+            )
+
+            metrics.db_bytes_written.inc(written, "journal")
+
+            if os.path.exists(f"{self.journal_path}.old"):
+                os.remove(f"{self.journal_path}.old")
+
+        finally:
+            self.compact_task = None
+
+    def sync_rotate(
+            self
+        ) -> None:
+        """
+        Moves the journal aside for compaction. If a journal
+        is still there from a compaction whose snapshot never
+        made it to disk, its records are still needed, so the
+        journal is added to the end of it instead.
         """
 
-        if self.lock:
-            print("Database is locked, skipping write")
+        old = f"{self.journal_path}.old"
+
+        if not os.path.exists(old):
+            os.replace(self.journal_path, old)
             return
 
-        self.lock = True
+        with open(self.journal_path, "rb") as src, open(old, "rb+") as dst:
+            dst.seek(0, os.SEEK_END)
+
+            # Don't glue the first record onto a torn line
+            if dst.tell():
+                dst.seek(-1, os.SEEK_END)
+
+                if dst.read(1) != b"\n":
+                    dst.write(b"\n")
+
+            shutil.copyfileobj(src, dst)
+            dst.flush()
+            os.fsync(dst.fileno())
+
+        os.remove(self.journal_path)
+
+    def sync_snapshot(
+            self,
+            data: dict
+        ) -> int:
+        return misc.atomic_write(
+            self.snapshot_path,
+            codec.dumps(data)
+        )
+
+    async def write(
+            self
+        ) -> None:
+        """
+        Writes all active data as a new snapshot.
+        """
+
+        await self.flush()
+
+    async def flush(
+            self
+        ) -> None:
+        """
+        Compacts the journal into a snapshot right away.
+        """
+
+        if self.compact_task is not None:
+            await self.compact_task
+
+        await self.compact()
+
+    async def close(
+            self
+        ) -> None:
+        """
+        Compacts and closes the journal. Should be
+        called on shutdown.
+        """
+
+        await self.flush()
+
+class SQLiteInterface:
+    # Extra indexed columns per collection, mapped to the
+    # entity field they're filled from
+    indexes = {
+        "keys": {"secret": "key"},
+        "devices": {"node": "node"}
+    }
+
+    def __init__(
+            self,
+            parent,
+            path: str = "db",
+            filename: str = "db.sqlite3",
+            shared: bool = False,
+            poll_interval: float = 0.5,
+            change_log: int = 10000
+        ) -> None:
+        """
+        Constructs a SQLite interface.
+
+        Each top-level collection (keys, nodes, devices,
+        phones, settings, ...) is stored as its own table,
+        with one row per entry. A put only rewrites the
+        row it touches. All SQLite calls run on a single
+        executor thread, so they're ordered and never
+        block the event loop.
+
+        In shared mode, several processes can use the same
+        file. Every write also appends to a change log
+        table, which the others poll to pick up what
+        changed (see poll()).
+
+        Parameters:
+            parent (Database) - Parent database that's
+                using this interface
+            path (str) - Folder name for database files.
+            filename (str) - SQLite file name inside path
+            shared (bool) - Whether other processes write
+                to the same file
+            poll_interval (float) - Seconds between polls
+                of the change log, in shared mode
+            change_log (int) - Changes to keep in the log.
+                Processes that fall further behind than this
+                reload everything.
+        """
+
+        self.parent = parent
+        self.path = path
+        self.filename = filename
+
+        self.data = None
+
+        self.shared = shared
+        self.poll_interval = poll_interval
+        self.change_log = change_log
+
+        # Tells this process's changes apart from everyone else's
+        self.origin = uuid.uuid4().hex
+
+        # Last change log entry that's been seen
+        self.seq = 0
+
+        self.connection = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = 1)
+
+    async def run(
+            self,
+            function,
+            *args
+        ):
+        """
+        Runs a blocking function on the SQLite thread.
+        """
+
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor,
+            function,
+            *args
+        )
+
+    def observe(
+            self,
+            elapsed: float,
+            written: int
+        ) -> None:
+        """
+        Records a write's metrics. The sync_ functions return
+        them instead, since metrics are only ever updated on
+        the event loop thread.
+        """
+
+        metrics.db_write_seconds.observe(elapsed, "sqlite")
+        metrics.db_bytes_written.inc(written, "sqlite")
+
+    @staticmethod
+    def table(
+            name: str
+        ) -> str:
+        """
+        Quotes a collection name for use as a table name.
+        """
+
+        if not re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", name):
+            raise exceptions.SecurityError(f"Invalid collection name {name}")
+
+        return f'"{name}"'
+
+    def row(
+            self,
+            collection: str,
+            name: str,
+            value
+        ) -> tuple:
+        """
+        Builds the row to store for one entry.
+        """
+
+        extra = [
+            value.get(field) if isinstance(value, dict) else None
+            for field in self.indexes.get(collection, {}).values()
+        ]
+
+        return (name, codec.dumps(value), *extra)
+
+    def rows(
+            self,
+            collection: str
+        ) -> list:
+        return [self.row(collection, name, value) for name, value in self.data[collection].items()]
+
+    async def load(
+            self
+        ) -> None:
+        """
+        Reads every table into self.data.
+        """
+
+        os.makedirs(f"{self.path}/backups", exist_ok = True)
+
+        self.data = await self.run(self.sync_load)
+
+    def sync_load(
+            self
+        ) -> dict:
+        # Other processes may hold the write lock for a while
+        self.connection = sqlite3.connect(f"{self.path}/{self.filename}", timeout = 30)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+
+        if self.shared:
+            with self.connection:
+                self.connection.execute(
+                    "CREATE TABLE IF NOT EXISTS _changes "
+                    "(seq INTEGER PRIMARY KEY, collection TEXT NOT NULL, uuid TEXT, origin TEXT NOT NULL)"
+                )
+
+        if not self.sync_tables() and os.path.exists(f"{self.path}/db.json"):
+            self.sync_migrate()
+
+        if self.shared:
+            # Read in the same transaction as the tables, so
+            # nothing written in between is missed
+            self.connection.execute("BEGIN")
+
+        try:
+            if self.shared:
+                self.seq = self.connection.execute(
+                    "SELECT COALESCE(MAX(seq), 0) FROM _changes"
+                ).fetchone()[0]
+
+            data = {}
+
+            for collection in self.sync_tables():
+                data[collection] = self.sync_read(collection)
+
+        finally:
+            if self.connection.in_transaction:
+                self.connection.rollback()
+
+        return data
+
+    def sync_migrate(
+            self
+        ) -> None:
+        """
+        Imports db.json from the JSON interface into a new
+        database.
+        """
+
+        # Other processes may be starting up too, so check
+        # again once nobody else can write
+        self.connection.execute("BEGIN IMMEDIATE")
+
+        with self.connection:
+            if self.sync_tables():
+                return
+
+            with open(f"{self.path}/db.json", "rb") as f:
+                self.data = codec.loads(f.read())
+
+            for collection in self.data:
+                self.sync_store(collection, self.rows(collection), True)
+
+        logger.log("info", "Imported db.json into SQLite", path = self.path)
+
+    def sync_tables(
+            self
+        ) -> list:
+        """
+        Lists the tables that hold collections, skipping
+        SQLite's and the interface's own.
+        """
+
+        return [
+            name for (name, ) in self.connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"
+            ) if not name.startswith(("_", "sqlite_"))
+        ]
+
+    def sync_read(
+            self,
+            collection: str,
+            name: Optional[str] = None
+        ):
+        """
+        Reads a collection, or one entry in it.
+
+        Returns:
+            dict of entries, or the entry. None if it doesn't exist.
+        """
+
+        try:
+            if name is None:
+                return {
+                    name: codec.loads(value) for name, value in self.connection.execute(
+                        f"SELECT uuid, value FROM {self.table(collection)}"
+                    )
+                }
+
+            row = self.connection.execute(
+                f"SELECT value FROM {self.table(collection)} WHERE uuid = ?",
+                (name, )
+            ).fetchone()
+
+        except sqlite3.OperationalError:
+            # No such table
+            return None
+
+        return None if row is None else codec.loads(row[0])
+
+    def sync_log(
+            self,
+            collection: str,
+            names: list
+        ) -> None:
+        """
+        Adds changes to the change log, in shared mode. A
+        name of None means the whole collection changed.
+        """
+
+        if self.shared:
+            self.connection.executemany(
+                "INSERT INTO _changes (collection, uuid, origin) VALUES (?, ?, ?)",
+                [(collection, name, self.origin) for name in names]
+            )
+
+    def sync_create(
+            self,
+            collection: str
+        ) -> None:
+        columns = self.indexes.get(collection, {})
+        table = self.table(collection)
+
+        self.connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} (uuid TEXT PRIMARY KEY, value TEXT NOT NULL"
+            + "".join(f", {column} TEXT" for column in columns)
+            + ")"
+        )
+
+        for column in columns:
+            self.connection.execute(
+                f'CREATE INDEX IF NOT EXISTS "{collection}_{column}" ON {table} ({column})'
+            )
+
+    def sync_store(
+            self,
+            collection: str,
+            rows: list,
+            replace: bool = False
+        ) -> int:
+        self.sync_create(collection)
+
+        if replace:
+            self.connection.execute(f"DELETE FROM {self.table(collection)}")
+            self.sync_log(collection, [None])
+
+        else:
+            self.sync_log(collection, [row[0] for row in rows])
+
+        if rows:
+            self.connection.executemany(
+                f"INSERT OR REPLACE INTO {self.table(collection)} VALUES ({', '.join('?' * len(rows[0]))})",
+                rows
+            )
+
+        return sum(len(row[1]) for row in rows)
+
+    def sync_upsert(
+            self,
+            collection: str,
+            rows: list,
+            replace: bool = False
+        ) -> tuple:
+        start = time.perf_counter()
+
+        with self.connection:
+            written = self.sync_store(collection, rows, replace)
+
+        return time.perf_counter() - start, written
+
+    def sync_upsert_many(
+            self,
+            batches: list
+        ) -> tuple:
+        start = time.perf_counter()
+        written = 0
+
+        with self.connection:
+            for collection, rows, replace in batches:
+                written += self.sync_store(collection, rows, replace)
+
+        return time.perf_counter() - start, written
+
+    def sync_delete(
+            self,
+            collection: str,
+            name: Optional[str] = None
+        ) -> None:
+        with self.connection:
+            if name is None:
+                self.connection.execute(f"DROP TABLE IF EXISTS {self.table(collection)}")
+
+            else:
+                self.connection.execute(
+                    f"DELETE FROM {self.table(collection)} WHERE uuid = ?",
+                    (name, )
+                )
+
+            self.sync_log(collection, [name])
+
+    def sync_modify(
+            self,
+            changes: dict
+        ) -> tuple:
+        start = time.perf_counter()
+        written = 0
+
+        results = {}
+
+        # Take the write lock before reading, so nobody
+        # else can write in between
+        self.connection.execute("BEGIN IMMEDIATE")
+
+        with self.connection:
+            for path, function in changes.items():
+                collection, name = path.split("/")
+
+                new = function(self.sync_read(collection, name))
+
+                if new is not None:
+                    written += self.sync_store(collection, [self.row(collection, name, new)])
+                    results[path] = new
+
+        return results, time.perf_counter() - start, written
+
+    def sync_poll(
+            self
+        ):
+        rows = self.connection.execute(
+            "SELECT seq, collection, uuid, origin FROM _changes WHERE seq > ? ORDER BY seq",
+            (self.seq, )
+        ).fetchall()
+
+        if not rows:
+            return {}, []
+
+        oldest = self.connection.execute("SELECT MIN(seq) FROM _changes").fetchone()[0]
+
+        if oldest > self.seq + 1:
+            # Missed entries that were pruned, so start over
+            logger.log("warn", "Fell behind the change log, reloading", seq = self.seq, oldest = oldest)
+
+            changed = {(collection, None) for collection in self.data}
+            changed.update((collection, None) for collection in self.sync_tables())
+
+        else:
+            changed = {
+                (collection, name) for seq, collection, name, origin in rows
+                if origin != self.origin
+            }
+
+        last = rows[-1][0]
+
+        if last // self.change_log > self.seq // self.change_log:
+            with self.connection:
+                self.connection.execute("DELETE FROM _changes WHERE seq <= ?", (last - self.change_log, ))
+
+        self.seq = last
+
+        put = {}
+        deleted = []
+
+        # Whole collections first, then entries in them
+        for collection, name in sorted(changed, key = lambda x: x[1] is not None):
+            path = collection if name is None else f"{collection}/{name}"
+
+            value = self.sync_read(collection, name)
+
+            if value is None:
+                deleted.append(path)
+
+            else:
+                put[path] = value
+
+        return put, deleted
+
+    async def update(
+            self,
+            path: str,
+            new
+        ) -> None:
+        """
+        Stores the row that path falls under. A
+        collection-level put replaces the whole table.
+        """
+
+        collection, *rest = path.split("/")
+
+        if not rest:
+            self.observe(*await self.run(self.sync_upsert, collection, self.rows(collection), True))
+            return
+
+        self.observe(*await self.run(
+            self.sync_upsert,
+            collection,
+            [self.row(collection, rest[0], self.data[collection][rest[0]])]
+        ))
+
+    async def update_many(
+            self,
+            changes: dict
+        ) -> None:
+        """
+        Stores the rows several paths fall under in
+        a single transaction.
+        """
+
+        tables = {}
+
+        for path in changes:
+            collection, *rest = path.split("/")
+
+            if not rest:
+                tables[collection] = None
+
+            elif tables.get(collection, {}) is not None:
+                tables.setdefault(collection, {})[rest[0]] = self.data[collection][rest[0]]
+
+        batches = [
+            (collection, self.rows(collection), True) if entries is None
+            else (collection, [self.row(collection, x, y) for x, y in entries.items()], False)
+            for collection, entries in tables.items()
+        ]
+
+        self.observe(*await self.run(self.sync_upsert_many, batches))
+
+    async def remove(
+            self,
+            path: str
+        ) -> None:
+        """
+        Deletes the row or table at path, or rewrites
+        the row if something deeper was deleted.
+        """
+
+        collection, *rest = path.split("/")
+
+        if len(rest) > 1:
+            await self.update(path, None)
+
+        else:
+            await self.run(self.sync_delete, collection, *rest)
+
+    async def modify(
+            self,
+            changes: dict
+        ) -> dict:
+        """
+        Atomically reads, changes and writes back entries,
+        so concurrent changes from other processes aren't lost.
+
+        Arguments:
+            changes (dict): Functions, keyed by entry path
+                (collection/uuid). Each is called with the
+                stored entry, or None if there isn't one, and
+                returns the new entry, or None to leave it be.
+
+        Returns:
+            dict of new entries, keyed by path
+        """
+
+        results, elapsed, written = await self.run(self.sync_modify, changes)
+        self.observe(elapsed, written)
+
+        return results
+
+    async def poll(
+            self
+        ):
+        """
+        Reads what other processes changed since the
+        last poll, from the change log.
+
+        Returns:
+            dict of new values keyed by path, and a list
+            of deleted paths
+        """
+
+        return await self.run(self.sync_poll)
+
+    async def write(
+            self
+        ) -> None:
+        """
+        Writes all active data to the database.
+        """
+
+        for collection in self.data:
+            self.observe(*await self.run(self.sync_upsert, collection, self.rows(collection), True))
+
+    async def flush(
+            self
+        ) -> None:
+        """
+        Waits for every queued write to finish.
+        """
+
+        await self.run(lambda: None)
+
+    async def close(
+            self
+        ) -> None:
+        """
+        Closes the connection. Should be called on shutdown.
+        """
+
+        await self.run(self.connection.close)
+        self.executor.shutdown()
+
+class ShardedInterface:
+    def __init__(
+            self,
+            parent,
+            path: str = "db",
+            sharded: tuple = ("keys", "nodes", "devices", "phones"),
+            workers: int = 4
+        ) -> None:
+        """
+        Constructs a sharded interface.
+
+        Collections in sharded get a folder with one file
+        per entry, like db/devices/<uuid>.json, so a put
+        only rewrites the entry it touches, no matter how
+        big the fleet is. Other collections (settings,
+        stats, ...) are small and get a single file each,
+        like db/settings.json. db/manifest.json records
+        which collections exist and how they're stored.
+
+        Writes run in order on one thread. Loading reads
+        every file in parallel on a pool of workers.
+
+        Parameters:
+            parent (Database) - Parent database that's
+                using this interface
+            path (str) - Folder name for database files.
+            sharded (tuple) - Collections to store one file
+                per entry
+            workers (int) - Threads to load files with
+        """
+
+        self.parent = parent
+        self.path = path
+        self.sharded = set(sharded)
+
+        self.data = None
+        self.manifest = None
+
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers = workers)
+        self.writer = concurrent.futures.ThreadPoolExecutor(max_workers = 1)
+
+    @property
+    def manifest_path(self) -> str:
+        return f"{self.path}/manifest.json"
+
+    @staticmethod
+    def check_name(
+            name: str
+        ) -> str:
+        """
+        Makes sure a collection or entry name is safe
+        to use as a file name.
+        """
+
+        if not re.fullmatch(r"[A-Za-z0-9_-][A-Za-z0-9_.-]*", name):
+            raise exceptions.SecurityError(f"Invalid name {name}")
+
+        return name
+
+    def file(
+            self,
+            collection: str,
+            name: Optional[str] = None
+        ) -> str:
+        if name is None:
+            return f"{self.path}/{self.check_name(collection)}.json"
+
+        return f"{self.path}/{self.check_name(collection)}/{self.check_name(name)}.json"
+
+    async def run(
+            self,
+            function,
+            *args
+        ):
+        """
+        Runs a blocking function on the writer thread.
+        """
+
+        return await asyncio.get_running_loop().run_in_executor(
+            self.writer,
+            function,
+            *args
+        )
+
+    async def load(
+            self
+        ) -> None:
+        """
+        Reads the manifest, then every collection, with
+        files spread across the worker pool.
+        """
+
+        os.makedirs(f"{self.path}/backups", exist_ok = True)
+
+        if not os.path.exists(self.manifest_path):
+            await self.migrate()
+            return
+
+        async with aiofiles.open(self.manifest_path, mode = "r") as f:
+            self.manifest = codec.loads(await f.read())
+
+        loop = asyncio.get_running_loop()
+        jobs = []
+
+        for collection, layout in self.manifest["collections"].items():
+            if layout == "sharded":
+                folder = f"{self.path}/{collection}"
+
+                names = [
+                    x[:-len(".json")] for x in os.listdir(folder)
+                    if x.endswith(".json")
+                ] if os.path.isdir(folder) else []
+
+                # A few hundred files per job, so scheduling
+                # doesn't cost more than reading
+                for i in range(0, len(names), 256):
+                    jobs.append((collection, names[i:i + 256]))
+
+            else:
+                jobs.append((collection, None))
+
+        results = await asyncio.gather(
+            *[loop.run_in_executor(self.pool, self.sync_read, *job) for job in jobs]
+        )
+
+        self.data = {collection: {} for collection in self.manifest["collections"]}
+
+        for (collection, names), value in zip(jobs, results):
+            if names is None:
+                self.data[collection] = value
+
+            else:
+                self.data[collection].update(value)
+
+    async def migrate(
+            self
+        ) -> None:
+        """
+        Starts a new sharded database, importing db.json
+        from the JSON interface if there is one.
+        """
+
+        try:
+            async with aiofiles.open(f"{self.path}/db.json", mode = "r") as f:
+                self.data = codec.loads(await f.read())
+
+        except FileNotFoundError:
+            self.data = {}
+
+        self.manifest = {"collections": {}}
+
+        await self.write()
+
+    def sync_read(
+            self,
+            collection: str,
+            names: Optional[list] = None
+        ):
+        if names is None:
+            with open(self.file(collection), "rb") as f:
+                return codec.loads(f.read())
+
+        entries = {}
+
+        for name in names:
+            with open(self.file(collection, name), "rb") as f:
+                entries[name] = codec.loads(f.read())
+
+        return entries
+
+    def sync_apply(
+            self,
+            ops: list
+        ) -> tuple:
+        """
+        Applies write operations in order. Each is one of
+            ("file", path, value) - Write value to path
+            ("unlink", path) - Delete path if it exists
+            ("collection", collection, entries) - Rewrite a
+                sharded collection, dropping stale files
+            ("drop", collection) - Delete a collection's files
+
+        Returns:
+            Seconds taken and bytes written, for metrics
+        """
+
+        start = time.perf_counter()
+        written = 0
+
+        for op, target, *value in ops:
+            if op == "file":
+                written += self.sync_write_file(target, value[0])
+
+            elif op == "unlink":
+                if os.path.exists(target):
+                    os.remove(target)
+
+            elif op == "collection":
+                entries = value[0]
+                folder = f"{self.path}/{self.check_name(target)}"
+
+                os.makedirs(folder, exist_ok = True)
+
+                for name in os.listdir(folder):
+                    if name.endswith(".json") and name[:-len(".json")] not in entries:
+                        os.remove(f"{folder}/{name}")
+
+                for name, entry in entries.items():
+                    written += self.sync_write_file(self.file(target, name), entry)
+
+            elif op == "drop":
+                if os.path.isdir(f"{self.path}/{self.check_name(target)}"):
+                    shutil.rmtree(f"{self.path}/{target}")
+
+                if os.path.exists(self.file(target)):
+                    os.remove(self.file(target))
+
+        return time.perf_counter() - start, written
+
+    async def apply(
+            self,
+            ops: list
+        ) -> None:
+        """
+        Applies write operations on the writer thread, and
+        records their metrics back on the event loop.
+        """
+
+        elapsed, written = await self.run(self.sync_apply, ops)
+
+        metrics.db_write_seconds.observe(elapsed, "sharded")
+        metrics.db_bytes_written.inc(written, "sharded")
+
+    @staticmethod
+    def sync_write_file(
+            path: str,
+            value
+        ) -> int:
+        return misc.atomic_write(path, codec.dumps(value))
+
+    def store(
+            self,
+            collection: str,
+            ops: list
+        ) -> None:
+        """
+        Adds the operations that store a whole collection,
+        registering it in the manifest if it's new.
+        """
+
+        # Written off the loop
+        self.parent.share(collection)
+        value = self.data[collection]
+
+        if collection in self.sharded and isinstance(value, dict):
+            layout = "sharded"
+            ops.append(("collection", collection, value))
+
+        else:
+            layout = "single"
+            ops.append(("file", self.file(collection), value))
+
+        if self.manifest["collections"].get(collection) != layout:
+            if collection in self.manifest["collections"]:
+                ops.insert(len(ops) - 1, ("drop", collection))
+
+            self.manifest = {
+                **self.manifest,
+                "collections": {**self.manifest["collections"], collection: layout}
+            }
+
+            ops.append(("file", self.manifest_path, self.manifest))
+
+    def changed(
+            self,
+            path: str,
+            ops: list
+        ) -> None:
+        """
+        Adds the operations that store whatever path falls under.
+        """
+
+        collection, *rest = path.split("/")
+
+        if rest and self.manifest["collections"].get(collection) == "sharded":
+            name = rest[0]
+
+            if name in self.data[collection]:
+                ops.append(("file", self.file(collection, name), self.data[collection][name]))
+
+            else:
+                ops.append(("unlink", self.file(collection, name)))
+
+        elif collection in self.data:
+            self.store(collection, ops)
+
+        elif collection in self.manifest["collections"]:
+            self.manifest = {
+                **self.manifest,
+                "collections": {
+                    x: y for x, y in self.manifest["collections"].items() if x != collection
+                }
+            }
+
+            ops.append(("drop", collection))
+            ops.append(("file", self.manifest_path, self.manifest))
+
+    async def update(
+            self,
+            path: str,
+            new
+        ) -> None:
+        """
+        Rewrites the file path falls under. For sharded
+        collections, that's just the one entry.
+        """
+
+        ops = []
+        self.changed(path, ops)
+
+        await self.apply(ops)
+
+    async def update_many(
+            self,
+            changes: dict
+        ) -> None:
+        """
+        Rewrites the files several paths fall under.
+        """
+
+        ops = []
+
+        for path in changes:
+            self.changed(path, ops)
+
+        await self.apply(ops)
+
+    async def remove(
+            self,
+            path: str
+        ) -> None:
+        """
+        Deletes the file path falls under, or rewrites it
+        if something inside an entry was deleted.
+        """
+
+        await self.update(path, None)
+
+    async def write(
+            self
+        ) -> None:
+        """
+        Rewrites every collection.
+        """
+
+        ops = []
+
+        for collection in self.data:
+            self.store(collection, ops)
+
+        ops.append(("file", self.manifest_path, self.manifest))
+
+        await self.apply(ops)
+
+    async def flush(
+            self
+        ) -> None:
+        """
+        Waits for every queued write to finish.
+        """
+
+        await self.run(lambda: None)
+
+    async def close(
+            self
+        ) -> None:
+        """
+        Waits for queued writes. Should be called on shutdown.
+        """
 
-        async with aiofiles.open(f"{self.path}/db.json", mode = "w+") as f:
-            await f.write(json.dumps(self.data, indent = 4))
+        await self.flush()
 
-        self.lock = False
+        self.writer.shutdown()
+        self.pool.shutdown()
 
 interfaces = {
-    "json": JSONInterface
+    "json": JSONInterface,
+    "journal": JournalInterface,
+    "sqlite": SQLiteInterface,
+    "sharded": ShardedInterface
 }
\ No newline at end of file
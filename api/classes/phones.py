@@ -0,0 +1,157 @@
+from typing import Optional
+
+class PhoneIndex:
+    def __init__(
+            self,
+            parent
+        ) -> None:
+        """
+        Constructs a PhoneIndex object.
+
+        Routes (toggle, node or device) pairs to the set
+        of phones that should be alerted, so finding the
+        recipients of an alert doesn't scan every phone.
+        The index is built lazily, then kept up to date
+        by add() and remove() as phones are written.
+
+        Parameters:
+            parent (Database): Database to read phones from
+        """
+
+        self.parent = parent
+
+        self.built = False
+
+        # (toggle, kind, uuid) -> set of phone UUIDs, where kind is
+        # "node", "device", or None for every phone with the toggle on
+        self.routes = {}
+
+        # toggle -> set of phone UUIDs that have it at all
+        self.toggles = {}
+
+        # phone UUID -> route keys it's in
+        self.entries = {}
+
+    def invalidate(
+            self
+        ) -> None:
+        """
+        Drops the index. It'll be rebuilt on the next lookup.
+        """
+
+        self.built = False
+        self.routes = {}
+        self.toggles = {}
+        self.entries = {}
+
+    async def build(
+            self
+        ) -> None:
+        """
+        Indexes every phone in the database.
+        """
+
+        self.invalidate()
+
+        for phone in (await self.parent.get("phones")).values():
+            self.index(phone)
+
+        self.built = True
+
+    def index(
+            self,
+            phone: dict
+        ) -> None:
+        keys = []
+
+        for toggle, enabled in phone["toggles"].items():
+            self.toggles.setdefault(toggle, set()).add(phone["uuid"])
+
+            if not enabled:
+                continue
+
+            keys.append((toggle, None, None))
+            keys += [(toggle, "node", x) for x in phone["enrolled_nodes"]]
+            keys += [(toggle, "device", x) for x in phone["enrolled_devices"]]
+
+        for key in keys:
+            self.routes.setdefault(key, set()).add(phone["uuid"])
+
+        self.entries[phone["uuid"]] = (list(phone["toggles"]), keys)
+
+    def add(
+            self,
+            phone: dict
+        ) -> None:
+        """
+        Indexes a created or edited phone.
+        """
+
+        if not self.built:
+            return
+
+        self.remove(phone["uuid"])
+        self.index(phone)
+
+    def remove(
+            self,
+            phone_uuid: str
+        ) -> None:
+        """
+        Removes a phone from the index.
+        """
+
+        if phone_uuid not in self.entries:
+            return
+
+        toggles, keys = self.entries.pop(phone_uuid)
+
+        for toggle in toggles:
+            self.toggles[toggle].discard(phone_uuid)
+
+        for key in keys:
+            self.routes[key].discard(phone_uuid)
+
+            if not self.routes[key]:
+                del self.routes[key]
+
+    async def match(
+            self,
+            toggle: str,
+            node: Optional[str] = None,
+            device: Optional[str] = None
+        ):
+        """
+        Finds phones with a toggle on, enrolled to a node or device.
+
+        Arguments:
+            toggle (str): Toggle to check
+            node (str): Node UUID, if matching by node
+            device (str): Device UUID, if matching by device
+                If neither is given, every phone with the
+                toggle on matches.
+
+        Returns:
+            set of phone UUIDs, and the UUID of a phone that
+            doesn't have the toggle at all (or None)
+        """
+
+        if not self.built:
+            await self.build()
+
+        missing = None
+
+        if len(self.toggles.get(toggle, ())) != len(self.entries):
+            # Only reached when something's misconfigured
+            missing = next(x for x in self.entries if x not in self.toggles.get(toggle, ()))
+
+        if node:
+            key = (toggle, "node", node)
+
+        elif device:
+            key = (toggle, "device", device)
+
+        else:
+            key = (toggle, None, None)
+
+        return self.routes.get(key, set()), missing
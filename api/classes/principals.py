@@ -0,0 +1,179 @@
+import ipaddress
+from typing import Optional
+
+from ..utils import logger
+
+class Principal:
+    def __init__(
+            self,
+            key_uuid: str,
+            key_data: dict,
+            nodes: set,
+            devices: set
+        ) -> None:
+        """
+        Constructs a Principal object.
+
+        A principal is a precompiled view of one key,
+        holding everything authenticate() needs to
+        accept or reject a request without touching the
+        rest of the database.
+
+        Parameters:
+            key_uuid (str): UUID of the key
+            key_data (dict): Key data, as stored in the database
+            nodes (set): UUIDs of nodes this key is registered to
+            devices (set): UUIDs of devices this key is registered to
+        """
+
+        self.uuid = key_uuid
+        self.permissions = frozenset(key_data["permissions"])
+        self.override = "override" in self.permissions
+
+        self.allow_any = key_data["allow_any"]
+        self.allowed_ips = set()
+        self.allowed_networks = []
+
+        for entry in key_data["allowed_ips"]:
+            if "/" in entry:
+                try:
+                    self.allowed_networks.append(ipaddress.ip_network(entry, strict = False))
+                    continue
+
+                except ValueError:
+                    pass
+
+            self.allowed_ips.add(entry)
+
+        self.nodes = frozenset(nodes)
+        self.devices = frozenset(devices)
+
+    def allows_ip(
+            self,
+            address: str
+        ) -> bool:
+        """
+        Checks if a request from an address is allowed.
+
+        Arguments:
+            address (str): Remote address of the request
+        """
+
+        if self.allow_any or address in self.allowed_ips:
+            return True
+
+        if not self.allowed_networks:
+            return False
+
+        try:
+            parsed = ipaddress.ip_address(address)
+
+        except ValueError:
+            return False
+
+        return any(parsed in network for network in self.allowed_networks)
+
+    def can_access_node(
+            self,
+            node_uuid: str
+        ) -> bool:
+        return self.override or node_uuid in self.nodes
+
+    def can_access_device(
+            self,
+            device_uuid: str
+        ) -> bool:
+        return self.override or device_uuid in self.devices
+
+class PrincipalCache:
+    def __init__(
+            self,
+            parent
+        ) -> None:
+        """
+        Constructs a PrincipalCache object.
+
+        Principals are indexed by key secret, so authentication
+        is a single lookup instead of a scan over every key.
+        The cache is built lazily and must be invalidated
+        whenever keys, or the key lists of nodes and devices,
+        are written.
+
+        Parameters:
+            parent (Database): Database to read keys from
+        """
+
+        self.parent = parent
+
+        self.principals = None
+
+        # Bumped on every invalidation, so long-lived
+        # connections can tell their principal may be stale
+        self.generation = 0
+
+    def invalidate(
+            self
+        ) -> None:
+        """
+        Drops all compiled principals. They'll be rebuilt
+        on the next lookup.
+        """
+
+        self.principals = None
+        self.generation += 1
+
+    async def get(
+            self,
+            secret: str
+        ) -> Optional[Principal]:
+        """
+        Gets the principal for a key secret.
+
+        Arguments:
+            secret (str): Key secret sent with the request
+
+        Returns:
+            Principal, or None if the key doesn't exist
+        """
+
+        if self.principals is None:
+            await self.build()
+
+        return self.principals.get(secret)
+
+    async def build(
+            self
+        ) -> None:
+        """
+        Compiles every key in the database into a principal.
+        A malformed key is logged and left out, so it can't
+        lock every other key out.
+        """
+
+        keys = await self.parent.get("keys")
+
+        node_acl = {}
+        for node_uuid, node in (await self.parent.get("nodes")).items():
+            for key_uuid in node["keys"]:
+                node_acl.setdefault(key_uuid, set()).add(node_uuid)
+
+        device_acl = {}
+        for device_uuid, device in (await self.parent.get("devices")).items():
+            for key_uuid in device["keys"]:
+                device_acl.setdefault(key_uuid, set()).add(device_uuid)
+
+        principals = {}
+
+        for key_uuid, key_data in keys.items():
+            try:
+                principals[key_data["key"]] = Principal(
+                    key_uuid,
+                    key_data,
+                    node_acl.get(key_uuid, ()),
+                    device_acl.get(key_uuid, ())
+                )
+
+            except Exception as e:
+                logger.log("error", "Skipping malformed key", key = key_uuid, error = repr(e))
+
+        self.principals = principals
@@ -0,0 +1,139 @@
+import asyncio
+
+from ..utils import codec
+
+class SubscriptionHub:
+    def __init__(
+            self,
+            queue_size: int = 64
+        ) -> None:
+        """
+        Constructs a SubscriptionHub object.
+
+        Keeps track of which websocket clients are
+        subscribed to which nodes and devices, and fans
+        out device data updates to them. Each update is
+        serialized once, and the same message is queued
+        for every subscriber.
+
+        Parameters:
+            queue_size (int): Messages to buffer per subscriber.
+                When a slow client's queue is full, its oldest
+                message is dropped.
+        """
+
+        self.queue_size = queue_size
+
+        # (kind, uuid) -> set of subscriber queues
+        self.topics = {}
+
+        # subscriber queue -> set of (kind, uuid)
+        self.subscribers = {}
+
+    def connect(
+            self
+        ) -> asyncio.Queue:
+        """
+        Registers a new subscriber.
+
+        Returns:
+            asyncio.Queue of (node UUID, device UUID,
+            serialized message) for it
+        """
+
+        queue = asyncio.Queue(self.queue_size)
+        self.subscribers[queue] = set()
+
+        return queue
+
+    def disconnect(
+            self,
+            queue: asyncio.Queue
+        ) -> None:
+        """
+        Removes a subscriber and all its subscriptions.
+        """
+
+        for topic in self.subscribers.pop(queue, ()):
+            self.unsubscribe(queue, *topic)
+
+    def subscribe(
+            self,
+            queue: asyncio.Queue,
+            kind: str,
+            uuid: str
+        ) -> None:
+        """
+        Subscribes to updates for a node or device.
+
+        Arguments:
+            queue (asyncio.Queue): Subscriber, from connect()
+            kind (str): "node" or "device"
+            uuid (str): UUID of the node or device
+        """
+
+        self.topics.setdefault((kind, uuid), set()).add(queue)
+        self.subscribers[queue].add((kind, uuid))
+
+    def unsubscribe(
+            self,
+            queue: asyncio.Queue,
+            kind: str,
+            uuid: str
+        ) -> None:
+        """
+        Unsubscribes from a node or device.
+        """
+
+        queues = self.topics.get((kind, uuid))
+
+        if queues is not None:
+            queues.discard(queue)
+
+            if not queues:
+                del self.topics[(kind, uuid)]
+
+        if queue in self.subscribers:
+            self.subscribers[queue].discard((kind, uuid))
+
+    def publish(
+            self,
+            node_uuid: str,
+            device_uuid: str,
+            data: dict
+        ) -> None:
+        """
+        Pushes a device data update to everyone subscribed
+        to the device or its node.
+
+        Arguments:
+            node_uuid (str): Node the device belongs to
+            device_uuid (str): Device that was updated
+            data (dict): The device's new data
+        """
+
+        node_queues = self.topics.get(("node", node_uuid))
+        device_queues = self.topics.get(("device", device_uuid))
+
+        if not node_queues and not device_queues:
+            return
+
+        queues = (node_queues or set()) | (device_queues or set())
+
+        message = codec.dumps(
+            {
+                "success": True,
+                "data": {
+                    "type": "data",
+                    "node": node_uuid,
+                    "device": device_uuid,
+                    "data": data
+                }
+            }
+        )
+
+        for queue in queues:
+            if queue.full():
+                queue.get_nowait()
+
+            queue.put_nowait((node_uuid, device_uuid, message))
@@ -0,0 +1,122 @@
+import asyncio
+import base64
+import urllib.parse
+import urllib.request
+
+from ..utils import exceptions
+
+class TwilioTransport:
+    def __init__(
+            self,
+            settings: dict
+        ) -> None:
+        """
+        Constructs a Twilio transport.
+
+        Transports are what the alert dispatcher uses to
+        actually send messages. Similar ones can be written
+        for any provider, if they have a configure() method
+        and an async send() method that raises TransportError
+        on failure.
+
+        Parameters:
+            settings (dict) - Database settings, holding
+                twilio_sid, twilio_token and twilio_from
+        """
+
+        self.configure(settings)
+
+    def configure(
+            self,
+            settings: dict
+        ) -> None:
+        """
+        Picks up changed credentials.
+        """
+
+        self.sid = settings["twilio_sid"]
+        self.token = settings["twilio_token"]
+        self.from_ = settings["twilio_from"]
+
+    async def send(
+            self,
+            number: str,
+            message: str
+        ) -> None:
+        """
+        Sends an SMS. The HTTP request runs in an
+        executor thread.
+        """
+
+        if not self.sid or not self.token or not self.from_:
+            raise exceptions.TransportError("Twilio is not configured")
+
+        await asyncio.get_running_loop().run_in_executor(
+            None,
+            self.sync_send,
+            number,
+            message
+        )
+
+    def sync_send(
+            self,
+            number: str,
+            message: str
+        ) -> None:
+        auth = base64.b64encode(f"{self.sid}:{self.token}".encode()).decode()
+
+        request = urllib.request.Request(
+            f"https://api.twilio.com/2010-04-01/Accounts/{self.sid}/Messages.json",
+            data = urllib.parse.urlencode(
+                {
+                    "From": self.from_,
+                    "To": number,
+                    "Body": message
+                }
+            ).encode(),
+            headers = {
+                "Authorization": f"Basic {auth}"
+            }
+        )
+
+        try:
+            with urllib.request.urlopen(request, timeout = 10) as response:
+                response.read()
+
+        except Exception as e:
+            raise exceptions.TransportError(f"Twilio request failed: {e}")
+
+class StubTransport:
+    def __init__(
+            self,
+            settings: dict
+        ) -> None:
+        """
+        Constructs a stub transport.
+
+        Doesn't send anything, just keeps every message
+        in self.sent. Useful for testing and local setups.
+
+        Parameters:
+            settings (dict) - Database settings (unused)
+        """
+
+        self.sent = []
+
+    def configure(
+            self,
+            settings: dict
+        ) -> None:
+        pass
+
+    async def send(
+            self,
+            number: str,
+            message: str
+        ) -> None:
+        self.sent.append((number, message))
+
+transports = {
+    "twilio": TwilioTransport,
+    "stub": StubTransport
+}
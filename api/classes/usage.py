@@ -0,0 +1,186 @@
+import asyncio
+import functools
+import time
+from typing import Optional
+
+from ..utils import logger
+
+class KeyUsage:
+    def __init__(
+            self,
+            parent,
+            flush_interval: float = 30
+        ) -> None:
+        """
+        Constructs a KeyUsage object.
+
+        Accumulates key usage statistics (last_used,
+        counter and last_ip) in memory, and writes them
+        back to the keys in one batch every flush_interval
+        seconds, instead of writing the database on every
+        authenticated request.
+
+        Parameters:
+            parent (Database): Database the keys are stored in
+            flush_interval (float): Seconds between flushes
+        """
+
+        self.parent = parent
+        self.flush_interval = flush_interval
+
+        # key uuid -> unflushed stats, with counter as a delta
+        self.pending = {}
+
+        self.task = None
+
+    def record(
+            self,
+            key_uuid: str,
+            address: str
+        ) -> None:
+        """
+        Records one use of a key.
+
+        Arguments:
+            key_uuid (str): Key that was used
+            address (str): Remote address it was used from
+        """
+
+        entry = self.pending.get(key_uuid)
+
+        if entry is None:
+            self.pending[key_uuid] = {
+                "last_used": int(time.time()),
+                "counter": 1,
+                "last_ip": address
+            }
+
+        else:
+            entry["last_used"] = int(time.time())
+            entry["counter"] += 1
+            entry["last_ip"] = address
+
+    @staticmethod
+    def apply(
+            key_data: dict,
+            entry: dict
+        ) -> dict:
+        return {
+            **key_data,
+            **entry,
+            "counter": key_data["counter"] + entry["counter"]
+        }
+
+    @classmethod
+    def increment(
+            cls,
+            key_data: Optional[dict],
+            entry: dict
+        ) -> Optional[dict]:
+        # Keys deleted since they were used stay deleted
+        if key_data is None:
+            return None
+
+        return cls.apply(key_data, entry)
+
+    def merge(
+            self,
+            key_uuid: str,
+            key_data: dict
+        ) -> dict:
+        """
+        Gets a key's data with unflushed usage applied.
+        """
+
+        entry = self.pending.get(key_uuid)
+
+        if entry is None:
+            return key_data
+
+        return self.apply(key_data, entry)
+
+    async def flush(
+            self
+        ) -> None:
+        """
+        Writes all unflushed usage to the database.
+        """
+
+        pending, self.pending = self.pending, {}
+
+        if not pending:
+            return
+
+        clock = self.parent.clock
+
+        try:
+            # Applied to whatever's stored at the time, so counts
+            # from other processes sharing the database add up
+            await self.parent.modify_many({
+                f"keys/{key_uuid}": functools.partial(self.increment, entry = entry)
+                for key_uuid, entry in pending.items()
+            })
+
+        except Exception:
+            # Keys whose version didn't move never got their
+            # counts, so they're retried on the next flush
+            self.restore({
+                key_uuid: entry for key_uuid, entry in pending.items()
+                if self.parent.version(f"keys/{key_uuid}") <= clock
+            })
+
+            raise
+
+    def restore(
+            self,
+            pending: dict
+        ) -> None:
+        """
+        Puts usage that failed to flush back in front of
+        whatever was recorded since.
+        """
+
+        for key_uuid, entry in pending.items():
+            newer = self.pending.get(key_uuid)
+
+            if newer is None:
+                self.pending[key_uuid] = entry
+
+            else:
+                newer["counter"] += entry["counter"]
+
+    def start(
+            self
+        ) -> None:
+        """
+        Starts flushing periodically. Must be called
+        from the serving event loop.
+        """
+
+        self.task = asyncio.get_running_loop().create_task(self.loop())
+
+    async def stop(
+            self
+        ) -> None:
+        """
+        Stops flushing periodically, and flushes
+        what's left.
+        """
+
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+        await self.flush()
+
+    async def loop(
+            self
+        ) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+
+            try:
+                await self.flush()
+
+            except Exception as e:
+                logger.log("error", "Flushing key usage failed", error = str(e))
@@ -1,2 +1,5 @@
+from . import codec
 from . import exceptions
+from . import logger
+from . import metrics
 from . import subprocess
\ No newline at end of file
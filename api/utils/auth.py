@@ -1,8 +1,7 @@
-from quart import request
+from quart import g, request
 
 import api
 import copy
-import time
 import traceback
 from . import messenger
 
@@ -21,33 +20,24 @@ async def authenticate(
             "Missing authentication key"
         ), None, None
 
-    key = args["key"]
+    principal = await api.db.principals.get(args["key"])
 
-    key_list = await api.db.get(
-        "keys"
-    )
-
-    key_uuid = None
-    for _key_uuid, data in key_list.items():
-        if data["key"] == key:
-            key_uuid = _key_uuid
-            key_data = data
-
-    if key_uuid is None:
+    if principal is None:
         return messenger.error(
             "AuthError",
             "Invalid key"
         ), None, None
 
-    if not key_data["allow_any"]:
-        if request.remote_addr not in key_data["allowed_ips"]:
-            return messenger.error(
-                "AuthError",
-                "Request not sent from whitelisted IP"
-            ), None, None
+    key_uuid = principal.uuid
+
+    if not principal.allows_ip(request.remote_addr):
+        return messenger.error(
+            "AuthError",
+            "Request not sent from whitelisted IP"
+        ), None, None
 
     # Check permissions
-    if permission not in key_data["permissions"]:
+    if permission not in principal.permissions:
         return messenger.error(
             "AuthError",
             f"You need permission {permission} to access this"
@@ -55,7 +45,7 @@ async def authenticate(
 
     # Authenticated!
     # Check if we should authenticate based on node or device
-    if "override" not in key_data["permissions"]:
+    if not principal.override:
         authed_one = False
 
         if node_authenticate:
@@ -70,18 +60,18 @@ async def authenticate(
                 authed_one = True
 
                 # Make sure key is registered
-                try:
-                    node = await api.db.get(
-                        f"nodes/{args['node']}"
-                    )
+                if not principal.can_access_node(args["node"]):
+                    try:
+                        node = await api.db.get(
+                            f"nodes/{args['node']}"
+                        )
+
+                    except:
+                        return messenger.error(
+                            "ArgError",
+                            f"Node {args['node']} does not exist"
+                        ), None, None
 
-                except:
-                    return messenger.error(
-                        "ArgError",
-                        f"Node {args['node']} does not exist"
-                    ), None, None
-
-                if key_uuid not in node["keys"]:
                     return messenger.error(
                         "AuthError",
                         f"Key {key_uuid} cannot access node {node['uuid']}"
@@ -104,18 +94,18 @@ async def authenticate(
 
                 authed_one = True
 
-                try:
-                    device = await api.db.get(
-                        f"devices/{args['device']}"
-                    )
+                if not principal.can_access_device(args["device"]):
+                    try:
+                        device = await api.db.get(
+                            f"devices/{args['device']}"
+                        )
 
-                except:
-                    return messenger.error(
-                        "ArgError",
-                        f"Device {args['device']} does not exist"
-                    ), None, None
+                    except:
+                        return messenger.error(
+                            "ArgError",
+                            f"Device {args['device']} does not exist"
+                        ), None, None
 
-                if key_uuid not in device["keys"]:
                     return messenger.error(
                         "AuthError",
                         f"Key {key_uuid} cannot access device {device['uuid']}"
@@ -128,13 +118,9 @@ async def authenticate(
             ), None, None
 
     # Update stuff
-    key_data["last_used"] = int(time.time())
-    key_data["counter"] += 1
-    key_data["last_ip"] = request.remote_addr
+    api.usage.record(key_uuid, request.remote_addr)
 
-    await api.db.put(
-        f"keys/{key_uuid}",
-        key_data
-    )
+    # For endpoints that check access to many things at once
+    g.principal = principal
 
-    return None, key_uuid, key_data["permissions"]
\ No newline at end of file
+    return None, key_uuid, principal.permissions
\ No newline at end of file
@@ -0,0 +1,79 @@
+import json
+
+from quart.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+
+except ImportError:
+    orjson = None
+
+backend = "orjson" if orjson is not None else "json"
+
+def dumps(
+        data,
+        pretty: bool = False,
+        default = None
+    ) -> str:
+    """
+    Encodes data as JSON, with orjson if it's installed.
+
+    Arguments:
+        data: Anything JSON serializable
+        pretty (bool): Indent the output. Otherwise it's as
+            compact as possible, with no whitespace.
+        default (callable): Called for objects that can't
+            be serialized otherwise
+
+    Returns:
+        str
+    """
+
+    if orjson is not None:
+        try:
+            return orjson.dumps(
+                data,
+                default = default,
+                option = orjson.OPT_INDENT_2 if pretty else 0
+            ).decode()
+
+        except TypeError:
+            # orjson is stricter than json, e.g. with non-str keys
+            # or huge ints, so let json have a go at it
+            pass
+
+    if pretty:
+        return json.dumps(data, indent = 4, default = default)
+
+    return json.dumps(data, separators = (",", ":"), default = default)
+
+def loads(
+        data
+    ):
+    """
+    Decodes JSON from str or bytes.
+    """
+
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+
+        except orjson.JSONDecodeError:
+            # orjson rejects some things json accepts, like
+            # NaN and Infinity, so let json have a go at it
+            pass
+
+    return json.loads(data)
+
+class JSONProvider(DefaultJSONProvider):
+    """
+    Quart JSON provider that goes through the codec,
+    so responses are encoded with orjson when it's
+    installed.
+    """
+
+    def dumps(self, obj, **kwargs) -> str:
+        return dumps(obj, default = kwargs.get("default", self.default))
+
+    def loads(self, s, **kwargs):
+        return loads(s)
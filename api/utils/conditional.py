@@ -0,0 +1,72 @@
+"""
+api.utils.conditional
+
+ETag and If-None-Match handling, built on the database's
+version counters.
+"""
+
+import api
+from . import messenger
+
+import hashlib
+from quart import request
+
+def etag(
+        *parts
+    ) -> str:
+    """
+    Builds a strong ETag out of the database epoch and parts.
+
+    Parts should be everything the response depends on,
+    usually database versions, plus the requesting key's UUID
+    when the response is filtered by what that key can see.
+    """
+
+    digest = hashlib.blake2b(
+        repr((api.db.epoch, parts)).encode(),
+        digest_size = 12
+    ).hexdigest()
+
+    return f'"{digest}"'
+
+def matches(
+        tag: str
+    ) -> bool:
+    """
+    Checks the request's If-None-Match header against tag.
+    """
+
+    header = request.headers.get("If-None-Match")
+
+    if not header:
+        return False
+
+    if header.strip() == "*":
+        return True
+
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+
+        # Weak comparison, as RFC 9110 requires for If-None-Match
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+
+        if candidate == tag:
+            return True
+
+    return False
+
+def not_modified(
+        tag: str
+    ):
+    return "", 304, {"ETag": tag}
+
+def send(
+        data,
+        tag: str
+    ):
+    """
+    Like messenger.send, but tags the response.
+    """
+
+    return messenger.send(data), 200, {"ETag": tag}
@@ -6,4 +6,15 @@ class NotFound(Exception):
     pass
 
 class SecurityError(Exception):
+    pass
+
+class ImmutableError(TypeError):
+    pass
+
+# -- SUBPROCESS --
+class SubprocessError(Exception):
+    pass
+
+# -- ALERTS --
+class TransportError(Exception):
     pass
\ No newline at end of file
@@ -0,0 +1,208 @@
+"""
+api.utils.logger
+
+Leveled, structured logging that never blocks the caller.
+
+Records are put on a bounded queue and written as JSON
+lines by a background thread, so slow consoles and disks
+stay off the request path. When the queue is full, records
+are dropped and counted instead of waiting. Debug records
+are sampled, since they're logged on hot paths.
+"""
+
+import atexit
+import queue
+import sys
+import threading
+import time
+
+from . import codec
+
+levels = {
+    "debug": 10,
+    "info": 20,
+    "warn": 30,
+    "error": 40
+}
+
+class Logger:
+    def __init__(
+            self,
+            level: str = "info",
+            path: str = None,
+            queue_size: int = 1024,
+            debug_sample: int = 100
+        ) -> None:
+        """
+        Constructs a Logger object.
+
+        Parameters:
+            level (str): Minimum level to log
+                Can be anything in levels.
+            path (str): File to append records to. If None,
+                records go to stderr.
+            queue_size (int): Records to buffer before dropping
+            debug_sample (int): Only every debug_sample-th debug
+                record is kept. 1 keeps all of them.
+        """
+
+        self.queue = queue.Queue(queue_size)
+        self.thread = None
+
+        self.dropped = 0
+        self.debug_counter = 0
+
+        self.configure(level, path, debug_sample)
+
+    def configure(
+            self,
+            level: str = "info",
+            path: str = None,
+            debug_sample: int = 100
+        ) -> None:
+        """
+        Changes where and what is logged.
+        """
+
+        if level not in levels:
+            raise ValueError(f"Invalid log level {level}")
+
+        self.level = levels[level]
+        self.path = path
+        self.debug_sample = max(1, debug_sample)
+
+    def log(
+            self,
+            level: str,
+            message: str,
+            **fields
+        ) -> None:
+        """
+        Queues a record. Never blocks.
+
+        Arguments:
+            level (str): One of debug, info, warn or error
+            message (str): What happened
+            **fields: Extra structured data for the record
+        """
+
+        if levels[level] < self.level:
+            return
+
+        if level == "debug":
+            self.debug_counter += 1
+
+            if self.debug_counter % self.debug_sample:
+                return
+
+        if self.thread is None:
+            self.start()
+
+        record = {
+            "time": time.time(),
+            "level": level,
+            "message": message,
+            **fields
+        }
+
+        try:
+            self.queue.put_nowait(record)
+
+        except queue.Full:
+            self.dropped += 1
+
+    def start(
+            self
+        ) -> None:
+        self.thread = threading.Thread(target = self.writer, daemon = True)
+        self.thread.start()
+
+    def stop(
+            self,
+            timeout: float = 1
+        ) -> None:
+        """
+        Writes out whatever is queued, then stops the writer.
+        """
+
+        if self.thread is None:
+            return
+
+        # Make room for the sentinel if needed
+        while True:
+            try:
+                self.queue.put(None, timeout = timeout)
+                break
+
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+
+                except queue.Empty:
+                    pass
+
+        self.thread.join(timeout)
+        self.thread = None
+
+    def writer(
+            self
+        ) -> None:
+        while True:
+            record = self.queue.get()
+
+            if record is None:
+                return
+
+            lines = [record]
+
+            # Write everything that's queued in one go
+            while True:
+                try:
+                    record = self.queue.get_nowait()
+
+                except queue.Empty:
+                    break
+
+                if record is None:
+                    self.write(lines)
+                    return
+
+                lines.append(record)
+
+            self.write(lines)
+
+    def write(
+            self,
+            records: list
+        ) -> None:
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+
+            records.append({
+                "time": time.time(),
+                "level": "warn",
+                "message": f"Dropped {dropped} log records"
+            })
+
+        text = "".join(codec.dumps(record, default = str) + "\n" for record in records)
+
+        try:
+            if self.path is None:
+                sys.stderr.write(text)
+                sys.stderr.flush()
+
+            else:
+                with open(self.path, "a") as f:
+                    f.write(text)
+
+        except Exception:
+            # Logging must never take the process down
+            pass
+
+default = Logger()
+
+log = default.log
+configure = default.configure
+
+atexit.register(default.stop)
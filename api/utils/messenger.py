@@ -1,4 +1,4 @@
-import json
+from . import logger
 
 def error(
         type: str,
@@ -15,8 +15,7 @@ def send(
         data
     ):
 
-    print(data)
-    print(len(data))
+    logger.log("debug", "Sending response", length = len(data))
 
     return {
         "success": True,
@@ -0,0 +1,227 @@
+"""
+api.utils.metrics
+
+In-process counters, gauges and histograms, rendered
+in the Prometheus text format.
+
+Everything here is updated from the event loop thread
+with plain integer and float arithmetic, so no locks
+are taken on the hot path.
+"""
+
+import bisect
+
+# Seconds, from 100us up to 10s
+default_buckets = (
+    0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5,
+    1, 2.5, 5, 10
+)
+
+registry = []
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_labels(names, values, extra = "") -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+
+    if extra:
+        pairs.append(extra)
+
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(value) if isinstance(value, float) else str(value)
+
+class Counter:
+    kind = "counter"
+
+    def __init__(
+            self,
+            name: str,
+            help: str,
+            labels: tuple = ()
+        ) -> None:
+        """
+        Constructs a Counter object, and registers it.
+
+        Parameters:
+            name (str): Metric name
+            help (str): Description shown in the output
+            labels (tuple): Label names. Values are passed
+                positionally, in the same order.
+        """
+
+        self.name = name
+        self.help = help
+        self.labels = labels
+
+        # label values -> value
+        self.series = {}
+
+        registry.append(self)
+
+    def inc(
+            self,
+            amount = 1,
+            *label_values
+        ) -> None:
+        self.series[label_values] = self.series.get(label_values, 0) + amount
+
+    def render(
+            self
+        ) -> list:
+        return [
+            f"{self.name}{format_labels(self.labels, values)} {format_value(value)}"
+            for values, value in self.series.items()
+        ]
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(
+            self,
+            amount = 1,
+            *label_values
+        ) -> None:
+        self.inc(-amount, *label_values)
+
+    def set(
+            self,
+            value,
+            *label_values
+        ) -> None:
+        self.series[label_values] = value
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(
+            self,
+            name: str,
+            help: str,
+            labels: tuple = (),
+            buckets: tuple = default_buckets
+        ) -> None:
+        """
+        Constructs a Histogram object, and registers it.
+
+        Parameters:
+            name (str): Metric name
+            help (str): Description shown in the output
+            labels (tuple): Label names. Values are passed
+                positionally, in the same order.
+            buckets (tuple): Sorted upper bounds of the buckets
+        """
+
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+
+        # label values -> [count per bucket (+Inf last), sum]
+        self.series = {}
+
+        registry.append(self)
+
+    def observe(
+            self,
+            value: float,
+            *label_values
+        ) -> None:
+        series = self.series.get(label_values)
+
+        if series is None:
+            series = self.series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(
+            self
+        ) -> list:
+        lines = []
+
+        for values, series in self.series.items():
+            cumulative = 0
+
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = 'le="' + format_value(float(bound)) + '"'
+
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, values, le)} {cumulative}")
+
+            lines.append(f"{self.name}_sum{format_labels(self.labels, values)} {format_value(series[-1])}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, values)} {cumulative}")
+
+        return lines
+
+def render() -> str:
+    """
+    Renders every registered metric in the Prometheus
+    text exposition format.
+    """
+
+    lines = []
+
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines += metric.render()
+
+    return "\n".join(lines) + "\n"
+
+# -- REQUESTS --
+request_seconds = Histogram(
+    "iot_request_duration_seconds",
+    "Time spent handling HTTP requests",
+    ("route", "method", "status")
+)
+
+auth_seconds = Histogram(
+    "iot_auth_duration_seconds",
+    "Time spent authenticating requests"
+)
+
+# -- DATABASE --
+db_put_seconds = Histogram(
+    "iot_db_put_duration_seconds",
+    "Time spent storing data, including the interface's write",
+    ("op",)
+)
+
+db_write_seconds = Histogram(
+    "iot_db_write_duration_seconds",
+    "Time spent writing the database to disk",
+    ("interface",)
+)
+
+db_bytes_written = Counter(
+    "iot_db_bytes_written_total",
+    "Bytes written to disk by the storage interface",
+    ("interface",)
+)
+
+# -- WEBSOCKETS --
+websocket_connections = Gauge(
+    "iot_websocket_connections",
+    "Open websocket connections",
+    ("endpoint",)
+)
+
+# -- INGEST --
+ingest_devices = Counter(
+    "iot_ingest_devices_total",
+    "Device data updates accepted"
+)
+
+ingest_values = Counter(
+    "iot_ingest_values_total",
+    "Individual data values accepted"
+)
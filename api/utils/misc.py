@@ -1,5 +1,6 @@
 from . import exceptions
 
+import os
 import random
 
 def follow(dict_, path):
@@ -16,6 +17,199 @@ def follow(dict_, path):
 
     return current
 
+def assign(dict_, path, value):
+    path = path.split("/")
+
+    parent = follow(dict_, "/".join(path[:-1])) if len(path) > 1 else dict_
+    parent[path[-1]] = value
+
+def remove(dict_, path):
+    path = path.split("/")
+
+    parent = follow(dict_, "/".join(path[:-1])) if len(path) > 1 else dict_
+
+    if path[-1] not in parent:
+        raise exceptions.NotFound()
+
+    del parent[path[-1]]
+
+# -- SNAPSHOTS --
+def immutable(self, *args, **kwargs):
+    raise exceptions.ImmutableError(f"{type(self).__name__} can't be modified, thaw() it first")
+
+class FrozenDict(dict):
+    """
+    A dict that can't be modified. Reads cost the same as
+    a dict's, and it serializes like one.
+    """
+
+    __setitem__ = __delitem__ = __ior__ = immutable
+    clear = pop = popitem = setdefault = update = immutable
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return FrozenDict, (dict(self), )
+
+class FrozenList(list):
+    """
+    A list that can't be modified.
+    """
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = immutable
+    append = extend = insert = pop = remove = clear = sort = reverse = immutable
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return FrozenList, (list(self), )
+
+def freeze(value):
+    """
+    Makes an immutable snapshot of value. Anything that's
+    already frozen is shared, not copied.
+    """
+
+    if isinstance(value, (FrozenDict, FrozenList)):
+        return value
+
+    if isinstance(value, dict):
+        return FrozenDict((x, freeze(y)) for x, y in value.items())
+
+    if isinstance(value, (list, tuple)):
+        return FrozenList(freeze(x) for x in value)
+
+    return value
+
+def thaw(value):
+    """
+    Makes a mutable deep copy of a snapshot, for editing.
+    """
+
+    if isinstance(value, dict):
+        return {x: thaw(y) for x, y in value.items()}
+
+    if isinstance(value, list):
+        return [thaw(x) for x in value]
+
+    return value
+
+def replace(dict_, changes, owned = None):
+    """
+    Copy-on-write version of assign(). Builds a new frozen
+    tree with every path in changes set to its value, copying
+    only the dicts along those paths and sharing the rest.
+
+    Copying a big collection costs as much as the collection,
+    so the caller can keep track of the collections nobody
+    else has seen yet in owned. Those are changed in place
+    instead, and the copies made here are added to it.
+
+    Arguments:
+        dict_ (FrozenDict): Tree to start from. It isn't modified,
+            apart from the collections in owned.
+        changes (dict): New values (already frozen), keyed by path
+        owned (dict): Collections that can be changed in place,
+            keyed by name
+
+    Returns:
+        FrozenDict
+    """
+
+    root = FrozenDict(dict_)
+    copied = {id(root)}
+
+    for path, value in changes.items():
+        *parents, name = path.split("/")
+
+        current = root
+
+        for i, parent in enumerate(parents):
+            if parent not in current:
+                raise exceptions.NotFound()
+
+            child = current[parent]
+
+            if id(child) in copied or (i == 0 and owned is not None and owned.get(parent) is child):
+                current = child
+                continue
+
+            child = FrozenDict(child)
+            copied.add(id(child))
+            dict.__setitem__(current, parent, child)
+
+            if i == 0 and owned is not None:
+                owned[parent] = child
+
+            current = child
+
+        dict.__setitem__(current, name, value)
+
+        # A collection that was replaced outright isn't ours anymore
+        if not parents and owned is not None and owned.get(name) is not value:
+            owned.pop(name, None)
+
+    return root
+
+def without(dict_, path, owned = None):
+    """
+    Copy-on-write version of remove(). Collections in
+    owned are changed in place, like with replace().
+    """
+
+    *parents, name = path.split("/")
+
+    parent = follow(dict_, "/".join(parents)) if parents else dict_
+
+    if name not in parent:
+        raise exceptions.NotFound()
+
+    if len(parents) == 1 and owned is not None and owned.get(parents[0]) is parent:
+        dict.__delitem__(parent, name)
+        return FrozenDict(dict_)
+
+    parent = FrozenDict(parent)
+    dict.__delitem__(parent, name)
+
+    if not parents:
+        if owned is not None:
+            owned.pop(name, None)
+
+        return parent
+
+    if len(parents) == 1 and owned is not None:
+        owned[parents[0]] = parent
+
+    return replace(dict_, {"/".join(parents): parent}, owned)
+
+def atomic_write(path, data):
+    """
+    Writes a file so that a crash leaves either the old or
+    the new contents, never a truncated mix. The data goes
+    to a temporary file that's synced, then renamed over path.
+    Blocking, so it should be run in an executor.
+    """
+
+    if isinstance(data, str):
+        data = data.encode()
+
+    with open(f"{path}.tmp", "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(f"{path}.tmp", path)
+
+    return len(data)
+
 chars = "abcdefghijklmnopqrstuvwxyz1234567890ABCDEFGHIJKLMNOPQRSTUVWXYZ."
 def generate_key(length = 32):
     comp = ""
@@ -1,5 +1,5 @@
 import asyncio
-#from . import logger
+from . import logger
 from . import exceptions
 
 import subprocess
@@ -48,8 +48,7 @@ class Command:
                 msg = await self.process.stdout.readuntil(b"\n")
                 data = msg.decode("ascii").rstrip()
 
-                # We will eventually log this
-                print(data)
+                logger.log("debug", data, command = self.command)
 
             except asyncio.IncompleteReadError:
                 done = True
@@ -1,19 +1,72 @@
-import api
 from . import auth
 from . import messenger
+from . import metrics
+
+import time
 
 from functools import wraps
-from quart import request
+from quart import g, request
+
+async def get_data():
+    """
+    Gets the request's arguments, parsing the body only
+    once per request no matter how many decorators ask.
+    """
+
+    if "request_data" not in g:
+        if request.method == "GET":
+            g.request_data = request.args
+
+        else: #elif request.method in ["PUT", "POST", "PATCH"]:
+            g.request_data = await request.get_json()
+
+    return g.request_data
+
+def compile_check(key, type_):
+    """
+    Compiles one validator entry into a function that
+    returns (error, value).
+
+    A dict type_ is a nested schema: the value must be a
+    dict, and each key it has must be in the schema and
+    of exactly that type.
+    """
+
+    if isinstance(type_, dict):
+        def check(value):
+            if type(value) != dict:
+                return f"Key {key} must be of type {dict}", None
+
+            for change, new_value in value.items():
+                if change not in type_:
+                    return f"Key {change} cannot be edited", None
+
+                if type(new_value) != type_[change]:
+                    return f"Key {change} is of wrong type", None
+
+            return None, value
+
+        return check
+
+    def check(value):
+        if type(value) == type_:
+            return None, value
+
+        try:
+            return None, type_(value)
+
+        except:
+            return f"Key {key} must be of type {type_}", None
+
+    return check
 
 def wrap_auth(category, node_auth = False, device_auth = False, either_auth = False, device_optional = False):
     def inner(function):
         @wraps(function)
         async def dec(*args, **kwargs):
-            if request.method == "GET":
-                data = request.args
+            data = await get_data()
 
-            else: #elif request.method in ["PUT", "POST", "PATCH"]:
-                data = await request.get_json()
+            start = time.perf_counter()
 
             err, key_uuid, permissions = await auth.authenticate(
                 data,
@@ -24,6 +77,8 @@ def wrap_auth(category, node_auth = False, device_auth = False, either_auth = Fa
                 device_optional
             )
 
+            metrics.auth_seconds.observe(time.perf_counter() - start)
+
             if err is not None:
                 return err
 
@@ -34,41 +89,34 @@ def wrap_auth(category, node_auth = False, device_auth = False, either_auth = Fa
     return inner
 
 def wrap_validate(values):
+    checks = [(key, compile_check(key, type_)) for key, type_ in values.items()]
+
     def inner(function):
         @wraps(function)
         async def dec(*args, **kwargs):
             validated = []
 
-            if request.method == "GET":
-                data = request.args
+            data = await get_data()
 
-            else: # request.method in ["PUT", "POST", "PATCH"]:
-                data = await request.get_json()
-
-            for key, type_ in values.items():
+            for key, check in checks:
                 if key not in data:
                     return messenger.error(
                         "ArgError",
                         f"Missing key {key}"
                     )
 
-                if type(data[key]) != type_:
-                    try:
-                        new = type_(data[key])
+                err, new = check(data[key])
 
-                    except:
-                        return messenger.error(
-                            "ArgError",
-                            f"Key {key} must be of type {type_}"
-                        )
+                if err is not None:
+                    return messenger.error(
+                        "ArgError",
+                        err
+                    )
 
-                else:
-                    new = data[key]
-                
                 validated.append(new)
 
             return await function(*args, *validated, **kwargs)
 
         return dec
-    
-    return inner
\ No newline at end of file
+
+    return inner
@@ -0,0 +1,153 @@
+"""
+benchmarks.codec
+
+Compares JSON encode/decode time and output size of the
+stdlib json module against api.utils.codec, on a synthetic
+fleet database.
+
+Usage:
+    python -m benchmarks.codec [--nodes 200] [--devices 10] [--repeat 5]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api.utils import codec
+
+def generate(nodes, devices_per_node):
+    """
+    Builds a database shaped like a real one, with a key
+    per node and a few readings per device.
+    """
+
+    db = {
+        "keys": {},
+        "nodes": {},
+        "devices": {},
+        "phones": {},
+        "settings": {},
+        "stats": {"counter": 0}
+    }
+
+    for i in range(nodes):
+        key_uuid = str(uuid.uuid4())
+        node_uuid = str(uuid.uuid4())
+
+        db["keys"][key_uuid] = {
+            "name": f"key-{i}",
+            "uuid": key_uuid,
+            "id": key_uuid.split("-", 1)[0],
+            "key": uuid.uuid4().hex,
+            "allow_any": False,
+            "allowed_ips": ["10.0.0.1", "10.0.0.0/24"],
+            "last_used": int(time.time()),
+            "last_ip": "10.0.0.1",
+            "counter": i * 100,
+            "permissions": ["data", "settings"]
+        }
+
+        node = {
+            "name": f"node-{i}",
+            "uuid": node_uuid,
+            "id": node_uuid.split("-", 1)[0],
+            "devices": [],
+            "last_updated": int(time.time()),
+            "last_updated_by": "10.0.0.1",
+            "data": {},
+            "keys": [key_uuid],
+            "producer": key_uuid
+        }
+
+        for j in range(devices_per_node):
+            device_uuid = str(uuid.uuid4())
+
+            db["devices"][device_uuid] = {
+                "name": f"device-{i}-{j}",
+                "uuid": device_uuid,
+                "id": device_uuid.split("-", 1)[0],
+                "node": node_uuid,
+                "type": "dht22_sensor",
+                "config": {"data_pin": j},
+                "polling_rate": 5,
+                "keys": [key_uuid],
+                "events": {
+                    "too_hot": {
+                        "type": "fault",
+                        "value": "temperature",
+                        "comparison": ">",
+                        "threshold": 30.0
+                    }
+                },
+                "data": {
+                    "temperature": 20 + j * 0.37,
+                    "humidity": 40 + j * 1.13,
+                    "valid": True
+                },
+                "last_updated": int(time.time()),
+                "last_updated_by": "10.0.0.1"
+            }
+
+            node["devices"].append(device_uuid)
+
+        db["nodes"][node_uuid] = node
+
+    return db
+
+def measure(function, repeat):
+    best = None
+
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nodes", type = int, default = 200)
+    parser.add_argument("--devices", type = int, default = 10)
+    parser.add_argument("--repeat", type = int, default = 5)
+    args = parser.parse_args()
+
+    db = generate(args.nodes, args.devices)
+
+    encoders = {
+        "json (indent=4)": lambda: json.dumps(db, indent = 4),
+        "json (compact)": lambda: json.dumps(db, separators = (",", ":")),
+        f"codec/{codec.backend} (pretty)": lambda: codec.dumps(db, pretty = True),
+        f"codec/{codec.backend} (compact)": lambda: codec.dumps(db)
+    }
+
+    decoders = {
+        "json": json.loads,
+        f"codec/{codec.backend}": codec.loads
+    }
+
+    print(f"{args.nodes} nodes, {args.nodes * args.devices} devices, best of {args.repeat}")
+    print()
+    print(f"{'encoder':<28} {'encode ms':>10} {'bytes':>12} {'json.loads ms':>14} {'codec.loads ms':>15}")
+
+    for name, encode in encoders.items():
+        encode_time, text = measure(encode, args.repeat)
+
+        decode_times = [
+            measure(lambda: decode(text), args.repeat)[0]
+            for decode in decoders.values()
+        ]
+
+        print(
+            f"{name:<28} {encode_time * 1000:>10.2f} {len(text.encode()):>12} "
+            f"{decode_times[0] * 1000:>14.2f} {decode_times[1] * 1000:>15.2f}"
+        )
+
+if __name__ == "__main__":
+    main()
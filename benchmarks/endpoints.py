@@ -0,0 +1,310 @@
+"""
+benchmarks.endpoints
+
+Drives the hot endpoints through Quart's test client against
+generated databases of growing size, and reports throughput
+and p50/p99 latency for each.
+
+Every size runs in its own process, on a fresh JSON database
+in a temporary directory, since main.py can only be imported
+once per process.
+
+Usage:
+    python -m benchmarks.endpoints [--sizes 10 100 1000] [--requests 500]
+        [--devices 5] [--output results.json]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import yaml
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ADMIN_KEY = "benchmark-admin"
+
+def generate(size, devices_per_node, defaults):
+    """
+    Builds a database with size nodes, each with its own
+    key and devices_per_node devices, plus an admin key.
+    """
+
+    db = json.loads(json.dumps(defaults))
+
+    def make_key(name, secret, permissions):
+        key_uuid = str(uuid.uuid4())
+
+        db["keys"][key_uuid] = {
+            "name": name,
+            "uuid": key_uuid,
+            "id": key_uuid.split("-", 1)[0],
+            "key": secret,
+            "allow_any": True,
+            "allowed_ips": [],
+            "last_used": -1,
+            "last_ip": None,
+            "counter": 0,
+            "permissions": permissions
+        }
+
+        return key_uuid
+
+    make_key("admin", ADMIN_KEY, ["admin", "settings", "data", "auth", "override"])
+
+    fleet = []
+
+    for i in range(size):
+        secret = uuid.uuid4().hex
+        key_uuid = make_key(f"node-{i}", secret, ["settings", "data"])
+        node_uuid = str(uuid.uuid4())
+
+        node = {
+            "name": f"node-{i}",
+            "uuid": node_uuid,
+            "id": node_uuid.split("-", 1)[0],
+            "devices": [],
+            "last_updated": -1,
+            "last_updated_by": None,
+            "data": {},
+            "keys": [key_uuid],
+            "producer": key_uuid
+        }
+
+        for j in range(devices_per_node):
+            device_uuid = str(uuid.uuid4())
+
+            db["devices"][device_uuid] = {
+                "name": f"device-{i}-{j}",
+                "uuid": device_uuid,
+                "id": device_uuid.split("-", 1)[0],
+                "type": "dht22_sensor",
+                "node": node_uuid,
+                "config": {"data_pin": j},
+                "polling_rate": 60,
+                "keys": [key_uuid],
+                "data": {},
+                "events": {
+                    "too_hot": {
+                        "type": "fault",
+                        "value": "temperature",
+                        "comparison": ">",
+                        "threshold": 90.0
+                    }
+                }
+            }
+
+            node["devices"].append(device_uuid)
+
+        db["nodes"][node_uuid] = node
+
+        fleet.append((secret, node_uuid, node["devices"]))
+
+    return db, fleet
+
+def summarize(latencies, elapsed):
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+    return {
+        "requests": len(latencies),
+        "throughput": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(0.5), 3),
+        "p99_ms": round(percentile(0.99), 3)
+    }
+
+async def drive(fleet, requests):
+    import api
+
+    def data_put():
+        secret, node_uuid, devices = random.choice(fleet)
+
+        return "put", "/data/put", {
+            "key": secret,
+            "device": random.choice(devices),
+            "data": {
+                "temperature": round(random.uniform(15, 30), 1),
+                "humidity": round(random.uniform(30, 60), 1),
+                "valid": True
+            }
+        }
+
+    def data_get():
+        secret, node_uuid, devices = random.choice(fleet)
+
+        return "get", "/data/get", {"key": secret, "node": node_uuid}
+
+    def data_get_many():
+        nodes = random.sample(fleet, min(50, len(fleet)))
+
+        return "put", "/data/get/many", {
+            "key": ADMIN_KEY,
+            "nodes": [node_uuid for secret, node_uuid, devices in nodes]
+        }
+
+    def settings_get_devices():
+        secret, node_uuid, devices = random.choice(fleet)
+
+        return "get", "/settings/get/devices", {"key": secret}
+
+    def admin_auth_get_keys():
+        return "get", "/admin/auth/get/keys", {"key": ADMIN_KEY}
+
+    endpoints = {
+        "/data/put": data_put,
+        "/data/get": data_get,
+        "/data/get/many": data_get_many,
+        "/settings/get/devices": settings_get_devices,
+        "/admin/auth/get/keys": admin_auth_get_keys
+    }
+
+    results = {}
+
+    async with api.app.test_app() as app:
+        client = app.test_client()
+
+        for name, make in endpoints.items():
+            async def call():
+                method, path, body = make()
+
+                if method == "get":
+                    response = await client.get(path, query_string = body)
+
+                else:
+                    response = await client.put(path, json = body)
+
+                result = await response.get_json()
+
+                if not result["success"]:
+                    raise RuntimeError(f"{path} failed: {result}")
+
+            # Warm up caches
+            for i in range(min(20, requests)):
+                await call()
+
+            latencies = []
+            started = time.perf_counter()
+
+            for i in range(requests):
+                start = time.perf_counter()
+                await call()
+                latencies.append(time.perf_counter() - start)
+
+            results[name] = summarize(latencies, time.perf_counter() - started)
+
+    return results
+
+def child(size, devices_per_node, requests):
+    """
+    Runs one size in this process, and prints the results
+    as a JSON line.
+    """
+
+    with open(f"{REPO}/config.yml") as f:
+        config = yaml.safe_load(f)
+
+    config["api"]["storage"] = {"type": "json", "options": {"path": "db"}}
+    config["api"]["alerts"]["transport"] = "stub"
+    config["api"]["logging"]["level"] = "warn"
+
+    db, fleet = generate(size, devices_per_node, config["api"]["db"])
+
+    directory = tempfile.mkdtemp(prefix = "iot-bench-")
+
+    try:
+        os.makedirs(f"{directory}/db/backups")
+
+        with open(f"{directory}/db/db.json", "w") as f:
+            json.dump(db, f)
+
+        with open(f"{directory}/config.yml", "w") as f:
+            yaml.safe_dump(config, f)
+
+        os.chdir(directory)
+        sys.path.insert(0, REPO)
+
+        import main
+
+        results = asyncio.get_event_loop().run_until_complete(drive(fleet, requests))
+
+    finally:
+        os.chdir(REPO)
+        shutil.rmtree(directory, ignore_errors = True)
+
+    print(json.dumps({"size": size, "devices": size * devices_per_node, "endpoints": results}))
+
+def revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd = REPO,
+            stderr = subprocess.DEVNULL
+        ).decode().strip()
+
+    except Exception:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type = int, nargs = "+", default = [10, 100, 1000])
+    parser.add_argument("--requests", type = int, default = 500)
+    parser.add_argument("--devices", type = int, default = 5, help = "Devices per node")
+    parser.add_argument("--output", help = "File to write results to, instead of stdout")
+    parser.add_argument("--child", type = int, help = argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        child(args.child, args.devices, args.requests)
+        return
+
+    runs = []
+
+    for size in args.sizes:
+        output = subprocess.check_output(
+            [
+                sys.executable, "-m", "benchmarks.endpoints",
+                "--child", str(size),
+                "--devices", str(args.devices),
+                "--requests", str(args.requests)
+            ],
+            cwd = REPO
+        )
+
+        run = json.loads(output.decode().strip().splitlines()[-1])
+        runs.append(run)
+
+        for name, result in run["endpoints"].items():
+            print(
+                f"N={size:<6} {name:<24} {result['throughput']:>9} req/s  "
+                f"p50 {result['p50_ms']:>8} ms  p99 {result['p99_ms']:>8} ms",
+                file = sys.stderr
+            )
+
+    report = {
+        "revision": revision(),
+        "python": platform.python_version(),
+        "requests": args.requests,
+        "devices_per_node": args.devices,
+        "runs": runs
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent = 4)
+
+    else:
+        print(json.dumps(report, indent = 4))
+
+if __name__ == "__main__":
+    main()
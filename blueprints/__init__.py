@@ -1,4 +1,6 @@
 from . import auth
 from . import settings
 from . import data
-from . import misc
\ No newline at end of file
+from . import misc
+from . import stats
+from . import websocket
\ No newline at end of file
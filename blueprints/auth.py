@@ -11,11 +11,25 @@ from api.utils import (
 )
 
 import uuid
-from quart import request
 
 
 # -- ADMIN ROUTES --
 
+def check_lists(
+        changes: dict
+    ):
+    """
+    Makes sure the list fields of a key hold only strings,
+    since they're compiled into its principal.
+    """
+
+    for key in ["allowed_ips", "permissions"]:
+        if any(type(x) != str for x in changes.get(key, [])):
+            return messenger.error(
+                "ArgError",
+                f"Key {key} must be a list of {str}"
+            )
+
 allowed_keys = ["uuid", "id", "allow_any", "allowed_ips", "last_used", "last_ip", "counter", "permissions", "name"]
 @api.app.route("/admin/auth/get/keys", methods = ["GET"])
 @api.auth("admin")
@@ -25,7 +39,7 @@ async def admin_auth_get_keys(data):
     keys = await api.db.get("keys")
 
     for key_uuid, data in keys.items():
-        comp[key_uuid] = {x: y for x, y in data.items() if x in allowed_keys}
+        comp[key_uuid] = {x: y for x, y in api.usage.merge(key_uuid, data).items() if x in allowed_keys}
 
     return messenger.send(comp)
 
@@ -44,7 +58,7 @@ async def admin_auth_get_key(data, key):
             f"Key {key} does not exist"
         )
 
-    comp = {x: y for x, y in key_data.items() if x in allowed_keys}
+    comp = {x: y for x, y in api.usage.merge(key, key_data).items() if x in allowed_keys}
 
     return messenger.send(comp)
 
@@ -52,6 +66,11 @@ async def admin_auth_get_key(data, key):
 @api.auth("admin")
 @api.validate({"name": str, "permissions": list, "allow_any": bool, "allowed_ips": list})
 async def admin_auth_create_key(data, name, permissions, allow_any, allowed_ips):
+    err = check_lists({"permissions": permissions, "allowed_ips": allowed_ips})
+
+    if err is not None:
+        return err
+
     # Create a UUID
     key_uuid = str(uuid.uuid4())
 
@@ -74,12 +93,20 @@ async def admin_auth_create_key(data, name, permissions, allow_any, allowed_ips)
         key_data
     )
 
+    api.db.principals.invalidate()
+
     return messenger.send(key_data)
 
+admin_allowed_edits = {"name": str, "key": str, "allow_any": bool, "allowed_ips": list, "permissions": list}
 @api.app.route("/admin/auth/edit/key", methods = ["POST", "PUT"])
 @api.auth("admin")
-@api.validate({"uuid": str, "changes": dict})
+@api.validate({"uuid": str, "changes": admin_allowed_edits})
 async def admin_auth_edit_key(data, key_uuid, changes):
+    err = check_lists(changes)
+
+    if err is not None:
+        return err
+
     try:
         key = await api.db.get(
             f"keys/{key_uuid}"
@@ -101,6 +128,8 @@ async def admin_auth_edit_key(data, key_uuid, changes):
         key
     )
 
+    api.db.principals.invalidate()
+
     return messenger.success()
 
 @api.app.route("/admin/auth/delete/key", methods = ["PUT"])
@@ -118,9 +147,11 @@ async def admin_auth_delete_key(data, key_uuid):
             f"Key {key_uuid} doesn't exist"
         )
 
-    del api.db.interface.data["keys"][key_uuid]
+    await api.db.delete(
+        f"keys/{key_uuid}"
+    )
 
-    await api.db.write()
+    api.db.principals.invalidate()
 
     return messenger.success()
 
@@ -128,55 +159,49 @@ async def admin_auth_delete_key(data, key_uuid):
 @api.app.route("/auth/get/key", methods = ["GET"])
 @api.auth("auth")
 async def auth_get_key(data):
-    key = data.get("key")
+    try:
+        details = await api.db.get(
+            f"keys/{data['__key_uuid__']}"
+        )
 
-    for key_uuid, details in (await api.db.get("keys")).items():
-        if details["key"] == key:
-            return messenger.send({x: y for x, y in details.items() if x in allowed_keys})
+    except:
+        return messenger.error(
+            "NotFound",
+            f"This should never happen, but your key was not found in the database."
+        )
 
-    return messenger.error(
-        "NotFound",
-        f"This should never happen, but your key was not found in the database."
-    )
+    return messenger.send({x: y for x, y in api.usage.merge(data["__key_uuid__"], details).items() if x in allowed_keys})
 
-allowed_edits = ["allowed_ips", "allow_any"]
+allowed_edits = {"allowed_ips": list, "allow_any": bool}
 @api.app.route("/auth/edit/key", methods = ["PUT"])
 @api.auth("auth")
-@api.validate({"changes": dict})
+@api.validate({"changes": allowed_edits})
 async def auth_edit_key(data, changes):
-    key = data.get("key")
+    key_uuid = data["__key_uuid__"]
+
+    err = check_lists(changes)
 
-    key_details = None
-    for _key_uuid, details in (await api.db.get("keys")).items():
-        if details["key"] == key:
-            key_uuid = _key_uuid
-            key_details = details
+    if err is not None:
+        return err
 
-    if key_details is None:
+    try:
+        key_details = misc.thaw(await api.db.get(
+            f"keys/{key_uuid}"
+        ))
+
+    except:
         return messenger.error(
             "NotFound",
             f"This should never happen, but your key was not found in the database."
         )
 
     for change, new_value in changes.items():
-        if change not in allowed_edits:
-            return messenger.error(
-                "ArgError",
-                f"Key {change} cannot be edited"
-            )
-
         if change not in key_details:
             return messenger.error(
                 "ArgError",
                 f"Key {change} does not exist"
             )
 
-        if type(new_value) != type(key_details[change]):
-            return messenger.error(
-                "ArgError",
-                f"Key {change} is of wrong type"
-            )
-        
         key_details[change] = new_value
 
     await api.db.put(
@@ -184,4 +209,6 @@ async def auth_edit_key(data, changes):
         key_details
     )
 
+    api.db.principals.invalidate()
+
     return messenger.success()
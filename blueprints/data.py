@@ -6,13 +6,13 @@ Allows for sending and retrieval of data.
 
 import api
 from api.utils import (
+    conditional,
     messenger,
-    misc
+    metrics
 )
 
 import time
-import uuid
-from quart import request
+from quart import g, request
 
 @api.app.route("/data/get", methods = ["GET"])
 @api.auth("data", True, True, True) # Authenticate either a node or device
@@ -26,6 +26,16 @@ async def data_get(data):
             f"nodes/{data['node']}"
         )
 
+        tag = conditional.etag(
+            max(
+                [api.db.version(f"nodes/{node['uuid']}")]
+                + [api.db.version(f"devices/{device}") for device in node["devices"]]
+            )
+        )
+
+        if conditional.matches(tag):
+            return conditional.not_modified(tag)
+
         for device in node["devices"]:
             try:
                 devices.append(
@@ -42,6 +52,11 @@ async def data_get(data):
 
     elif "device" in data:
         # Device retrieval
+        tag = conditional.etag(api.db.version(f"devices/{data['device']}"))
+
+        if conditional.matches(tag):
+            return conditional.not_modified(tag)
+
         devices = [
             await api.db.get(
                 f"devices/{data['device']}"
@@ -59,7 +74,110 @@ async def data_get(data):
     for device in devices:
         data[device["uuid"]] = device["data"]
 
-    return messenger.send(data)
+    return conditional.send(data, tag)
+
+@api.app.route("/data/get/many", methods = ["POST", "PUT"])
+@api.auth("data")
+async def data_get_many(data):
+    requested = {}
+
+    for kind in ["nodes", "devices"]:
+        requested[kind] = data.get(kind, [])
+
+        if type(requested[kind]) != list or any(type(x) != str for x in requested[kind]):
+            return messenger.error(
+                "ArgError",
+                f"Key {kind} must be a list of UUIDs"
+            )
+
+    principal = g.principal
+
+    # Device UUIDs to return, in order, without repeats
+    wanted = {}
+    errors = {}
+
+    for node_uuid in requested["nodes"]:
+        node = lookup("nodes", node_uuid)
+
+        if node is None:
+            errors[node_uuid] = messenger.error(
+                "NotFound",
+                f"Node {node_uuid} does not exist"
+            )
+
+        elif not principal.can_access_node(node_uuid):
+            errors[node_uuid] = messenger.error(
+                "AuthError",
+                f"Key {principal.uuid} cannot access node {node_uuid}"
+            )
+
+        else:
+            wanted.update(dict.fromkeys(node["devices"]))
+
+    for device_uuid in requested["devices"]:
+        if lookup("devices", device_uuid) is None:
+            errors[device_uuid] = messenger.error(
+                "NotFound",
+                f"Device {device_uuid} does not exist"
+            )
+
+        elif not principal.can_access_device(device_uuid):
+            errors[device_uuid] = messenger.error(
+                "AuthError",
+                f"Key {principal.uuid} cannot access device {device_uuid}"
+            )
+
+        else:
+            wanted.setdefault(device_uuid, None)
+
+    # What's visible depends on the key and what it can access,
+    # so both are part of the tag, along with what was denied
+    tag = conditional.etag(
+        principal.uuid,
+        sorted(requested["nodes"]),
+        sorted(requested["devices"]),
+        sorted(errors),
+        max(
+            [api.db.version("nodes"), api.db.version(f"keys/{principal.uuid}")]
+            + [api.db.version(f"devices/{device_uuid}") for device_uuid in wanted]
+        )
+    )
+
+    if conditional.matches(tag):
+        return conditional.not_modified(tag)
+
+    readings = {}
+
+    for device_uuid in wanted:
+        device = lookup("devices", device_uuid)
+
+        if device is None:
+            errors[device_uuid] = messenger.error(
+                "NotFound",
+                f"Device {device_uuid} does not exist - node out of sync?"
+            )
+            continue
+
+        readings[device_uuid] = device["data"]
+
+    return conditional.send(
+        {
+            "devices": readings,
+            "errors": errors
+        },
+        tag
+    )
+
+def lookup(
+        collection: str,
+        entity_uuid: str
+    ):
+    # Entries one at a time, since getting a whole collection
+    # makes the next write to it copy the collection
+    if "/" in entity_uuid:
+        return None
+
+    return api.db.lookup(f"{collection}/{entity_uuid}")
 
 @api.app.route("/data/put", methods = ["PUT"])
 @api.auth("settings", True, True, True)
@@ -76,9 +194,111 @@ async def data_put(data, device, device_data):
             f"Device {device} does not exist"
         )
 
+    valid, comp = validate_data(device, device_data)
+
+    if not valid:
+        return comp
+
+    timestamp = time.time()
+    previous = device["data"]
+    device = apply_data(device, comp, timestamp, request.remote_addr)
+
+    await api.db.put(
+        f"devices/{device['uuid']}",
+        device
+    )
+
+    await after_ingest(device, previous, comp, timestamp)
+
+    return messenger.success()
+
+@api.app.route("/data/put/batch", methods = ["PUT"])
+@api.auth("settings", True) # Authenticate the node
+@api.validate({"node": str, "devices": dict})
+async def data_put_batch(data, node_uuid, batch):
+    try:
+        node = await api.db.get(
+            f"nodes/{node_uuid}"
+        )
+
+    except:
+        return messenger.error(
+            "NotFound",
+            f"Node {node_uuid} does not exist"
+        )
+
+    results = {}
+    changes = {}
+    accepted = []
+
+    timestamp = time.time()
+
+    principal = g.principal
+
+    for device_uuid, device_data in batch.items():
+        if device_uuid not in node["devices"]:
+            results[device_uuid] = messenger.error(
+                "NotFound",
+                f"Device {device_uuid} is not registered to node {node_uuid}"
+            )
+            continue
+
+        # Same check /data/put makes for a single device
+        if not principal.can_access_device(device_uuid):
+            results[device_uuid] = messenger.error(
+                "AuthError",
+                f"Key {principal.uuid} cannot access device {device_uuid}"
+            )
+            continue
+
+        try:
+            device = await api.db.get(
+                f"devices/{device_uuid}"
+            )
+
+        except:
+            results[device_uuid] = messenger.error(
+                "NotFound",
+                f"Device {device_uuid} does not exist"
+            )
+            continue
+
+        if type(device_data) != dict:
+            results[device_uuid] = messenger.error(
+                "ArgError",
+                f"Data for device {device_uuid} must be of type {dict}"
+            )
+            continue
+
+        valid, comp = validate_data(device, device_data)
+
+        if not valid:
+            results[device_uuid] = comp
+            continue
+
+        previous = device["data"]
+        device = apply_data(device, comp, timestamp, request.remote_addr)
+
+        accepted.append((device, previous, comp))
+        changes[f"devices/{device_uuid}"] = device
+        results[device_uuid] = messenger.success()
+
+    # Persist everything at once
+    if changes:
+        await api.db.put_many(changes)
+
+    for device, previous, comp in accepted:
+        await after_ingest(device, previous, comp, timestamp)
+
+    return messenger.send(results)
+
+def validate_data(
+        device: dict,
+        device_data: dict
+    ):
     # Make sure device data abides by device rules
     if device["type"] not in api.config.devices:
-        return messenger.error(
+        return False, messenger.error(
             "APIError",
             f"Device type {device['type']} has no set data rules"
         )
@@ -88,30 +308,134 @@ async def data_put(data, device, device_data):
 
     for key, value in device_data.items():
         if key not in device_rules:
-            return messenger.error(
+            return False, messenger.error(
                 "ArgError",
                 f"Data key {key} is not supported by device {device['type']}"
             )
 
         if type(value) not in [type(x) for x in device_rules[key]] and type(value) != None:
 
-            return messenger.error(
+            return False, messenger.error(
                 "ArgError",
                 f"Data key {key} must be of type {type(device_rules[key])} or None"
             )
 
         comp[key] = value
 
-    device["data"] = {
-        **comp,
-        "info": {
-            "last_updated": int(time.time()),
-            "updated_by": str(request.remote_addr)
+    return True, comp
+
+def apply_data(
+        device: dict,
+        comp: dict,
+        timestamp: float,
+        updated_by: str
+    ):
+    # Returns a new device, rather than editing the snapshot
+    return {
+        **device,
+        "data": {
+            **comp,
+            "info": {
+                "last_updated": int(timestamp),
+                "updated_by": str(updated_by)
+            }
         }
     }
 
-    await api.db.put(
-        f"devices/{device['uuid']}",
-        device
-    )   
-    return messenger.success()
\ No newline at end of file
+@api.app.route("/data/history", methods = ["GET"])
+@api.auth("data", False, True) # Authenticate the device
+@api.validate({"device": str, "value": str})
+async def data_history(data, device_uuid, key):
+    try:
+        device = await api.db.get(
+            f"devices/{device_uuid}"
+        )
+
+    except:
+        return messenger.error(
+            "NotFound",
+            f"Device {device_uuid} does not exist"
+        )
+
+    if key not in api.config.devices.get(device["type"], {}).get("data", {}):
+        return messenger.error(
+            "ArgError",
+            f"Data key {key} is not supported by device {device['type']}"
+        )
+
+    # Optional time range
+    bounds = []
+    for name in ["start", "end"]:
+        if data.get(name) is None:
+            bounds.append(None)
+            continue
+
+        try:
+            bounds.append(float(data[name]))
+
+        except:
+            return messenger.error(
+                "ArgError",
+                f"Key {name} must be of type {float}"
+            )
+
+    resolution = data.get("resolution", "raw")
+
+    if resolution not in api.history.resolutions:
+        return messenger.error(
+            "ArgError",
+            f"Resolution {resolution} is not one of {', '.join(api.history.resolutions)}"
+        )
+
+    return messenger.send(
+        {
+            "device": device_uuid,
+            "value": key,
+            "resolution": resolution,
+            "samples": api.history.query(device_uuid, key, *bounds, resolution)
+        }
+    )
+
+async def after_ingest(
+        device: dict,
+        previous: dict,
+        comp: dict,
+        timestamp: float
+    ):
+    metrics.ingest_devices.inc()
+    metrics.ingest_values.inc(len(comp))
+
+    # Record history, push to subscribers and run events
+    api.history.record(device["uuid"], comp, timestamp)
+    api.subscriptions.publish(device["node"], device["uuid"], device["data"])
+    await api.events.evaluate(device, previous, comp)
+
+async def replicated(
+        path: str,
+        old,
+        new
+    ):
+    """
+    Database listener for readings ingested by other
+    processes. Their events already fired there, so this
+    process's history, subscribers and rule states only
+    catch up, with the latest reading as of each poll.
+    """
+
+    collection, *rest = path.split("/")
+
+    if collection != "devices" or len(rest) != 1 or new is None:
+        return
+
+    info = new["data"].get("info")
+
+    if info is None or (old is not None and old["data"] == new["data"]):
+        return
+
+    comp = {x: y for x, y in new["data"].items() if x != "info"}
+
+    api.history.record(new["uuid"], comp, info["last_updated"])
+    api.subscriptions.publish(new["node"], new["uuid"], new["data"])
+    await api.events.evaluate(new, {} if old is None else old["data"], comp, False)
+
+api.db.listen(replicated)
\ No newline at end of file
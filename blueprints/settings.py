@@ -5,19 +5,21 @@ Allows for management of settings.
 """
 
 import api
+from api.classes import events
 from api.utils import (
+    conditional,
     messenger,
     misc
 )
 
-import copy
 from typing import Optional
+import functools
 import uuid
-from quart import request
 
 # -- SETTINGS --
 
 allowed_keys = ["twilio_sid", "twilio_token", "twilio_from", "fault_format", "exception_format", "start_format", "stop_format", "error_format", "pause_format", "unpause_format"]
+settings_edit_schema = {x: str for x in allowed_keys}
 @api.app.route("/settings/get", methods = ["GET"])
 @api.auth("settings")
 async def settings_get(data):
@@ -25,29 +27,17 @@ async def settings_get(data):
 
 @api.app.route("/settings/edit", methods = ["PUT"])
 @api.auth("settings")
-@api.validate({"changes": dict})
+@api.validate({"changes": settings_edit_schema})
 async def settings_edit(data, changes):
-    settings = await api.db.get("settings")
+    settings = misc.thaw(await api.db.get("settings"))
 
     for key, value in changes.items():
-        if key not in allowed_keys:
-            return messenger.error(
-                "ArgError",
-                f"Key {key} cannot be edited"
-            )
-
         if key not in settings:
             return messenger.error(
                 "ArgError",
                 f"Key {key} does not exist"
             )
 
-        if type(value) != type(settings[key]):
-            return messenger.error(
-                "ArgError",
-                f"Key {key} is of wrong type"
-            )
-        
         settings[key] = value
 
     await api.db.put(
@@ -55,14 +45,36 @@ async def settings_edit(data, changes):
         settings
     )
 
+    api.alerts.configure(settings)
+
     return messenger.success()
 
+async def settings_changed(
+        path: str,
+        old,
+        new
+    ):
+    """
+    Database listener for settings edited by other processes.
+    """
+
+    if path.split("/")[0] == "settings":
+        api.alerts.configure(await api.db.get("settings"))
+
+api.db.listen(settings_changed)
+
 # -- PHONES --
 
 phone_keys = ["number", "toggles", "checkin_interval", "enrolled_devices", "enrolled_nodes", "name"]
+phone_edit_schema = {"number": str, "toggles": dict, "checkin_interval": int, "enrolled_devices": list, "enrolled_nodes": list, "name": str}
 @api.app.route("/settings/get/phones", methods = ["GET"])
 @api.auth("settings")
 async def settings_get_phones(data):
+    tag = conditional.etag(api.db.version("phones"))
+
+    if conditional.matches(tag):
+        return conditional.not_modified(tag)
+
     comp = {}
 
     phones = await api.db.get("phones")
@@ -70,36 +82,30 @@ async def settings_get_phones(data):
     for key_uuid, data in phones.items():
         comp[key_uuid] = {x: y for x, y in data.items() if x in phone_keys}
 
-    return messenger.send(comp)
+    return conditional.send(comp, tag)
 
 @api.app.route("/settings/get/matching_phones", methods = ["GET"])
 @api.auth("settings", True, True, True, True) # Any node, optional
 @api.validate({"toggle": str})
 async def settings_get_matching_phones(data, toggle):
-    comp = {}
-
-    phones = await api.db.get("phones")
-    for phone_uuid, details in phones.items():
-        # First, check toggle
-        if toggle not in details["toggles"]:
-            return messenger.error(
-                "ArgError",
-                f"Toggle {toggle} not found in phone {phone_uuid}"
-            )
+    matches, missing = await api.db.phone_index.match(
+        toggle,
+        data.get("node"),
+        data.get("device")
+    )
 
-        if details["toggles"][toggle]:
-            # Ensure phone is enrolled to device or node
-            if data.get("node"):
-                if data["node"] in details["enrolled_nodes"]:
-                    comp[phone_uuid] = details
+    if missing is not None:
+        return messenger.error(
+            "ArgError",
+            f"Toggle {toggle} not found in phone {missing}"
+        )
 
-            elif data.get("device"):
-                if data["device"] in details["enrolled_devices"]:
-                    comp[phone_uuid] = details
+    comp = {}
 
-            else:
-                # If neither, add it - means any they have access to
-                comp[phone_uuid] = details
+    for phone_uuid in matches:
+        comp[phone_uuid] = await api.db.get(
+            f"phones/{phone_uuid}"
+        )
 
     # Return it
     return messenger.send(comp)
@@ -134,16 +140,18 @@ async def settings_create_phone(data, name, number):
         phone_data
     )
 
+    api.db.phone_index.add(phone_data)
+
     return messenger.send(phone_data)
 
 @api.app.route("/settings/edit/phone", methods = ["PUT"])
 @api.auth("settings")
-@api.validate({"uuid": str, "changes": dict})
+@api.validate({"uuid": str, "changes": phone_edit_schema})
 async def settings_edit_phone(data, phone_uuid, changes):
     try:
-        phone = await api.db.get(
+        phone = misc.thaw(await api.db.get(
             f"phones/{phone_uuid}"
-        )
+        ))
 
     except:
         return messenger.error(
@@ -151,25 +159,26 @@ async def settings_edit_phone(data, phone_uuid, changes):
             f"Phone {phone_uuid} doesn't exist"
         )
 
-    for change, new_value in changes.items():
-        if change not in phone_keys:
+    # Enrolments are indexed, so they must be UUIDs that exist
+    for change, collection in [("enrolled_nodes", "nodes"), ("enrolled_devices", "devices")]:
+        if change not in changes:
+            continue
+
+        existing = await api.db.get(collection)
+
+        if any(type(x) != str or x not in existing for x in changes[change]):
             return messenger.error(
                 "ArgError",
-                f"Key {change} cannot be edited"
+                f"Key {change} must be a list of existing {collection[:-1]} UUIDs"
             )
 
+    for change, new_value in changes.items():
         if change not in phone:
             return messenger.error(
                 "ArgError",
                 f"Key {change} does not exist"
             )
 
-        if type(new_value) != type(phone[change]):
-            return messenger.error(
-                "ArgError",
-                f"Key {change} is of wrong type"
-            )
-        
         phone[change] = new_value
 
     await api.db.put(
@@ -177,6 +186,8 @@ async def settings_edit_phone(data, phone_uuid, changes):
         phone
     )
 
+    api.db.phone_index.add(phone)
+
     return messenger.success()
 
 @api.app.route("/settings/delete/phone", methods = ["PUT"])
@@ -194,9 +205,11 @@ async def settings_delete_phone(data, phone_uuid):
             f"Phone {phone_uuid} doesn't exist"
         )
 
-    del api.db.interface.data["phones"][phone_uuid]
+    await api.db.delete(
+        f"phones/{phone_uuid}"
+    )
 
-    await api.db.write()
+    api.db.phone_index.remove(phone_uuid)
 
     return messenger.success()
 
@@ -206,17 +219,24 @@ device_edit_keys = ["config", "polling_rate", "keys", "events"]
 @api.app.route("/settings/get/devices", methods = ["GET"])
 @api.auth("settings")
 async def settings_get_devices(data):
+    override = "override" in data["__permissions__"]
+
+    # What's returned depends on which key is asking
+    # Readings aren't listed, so they don't change the tag
+    tag = conditional.etag(api.db.version("devices", True), data["__key_uuid__"], override)
+
+    if conditional.matches(tag):
+        return conditional.not_modified(tag)
+
     comp = {}
 
     devices = await api.db.get("devices")
 
-    override = "override" in data["__permissions__"]
-
     for key_uuid, device_data in devices.items():
         if data["__key_uuid__"] in device_data["keys"] or override:
             comp[key_uuid] = {x: y for x, y in device_data.items() if x in device_keys}
 
-    return messenger.send(comp)
+    return conditional.send(comp, tag)
 
 @api.app.route("/settings/get/device", methods = ["GET"])
 @api.auth("settings", False, True) # Validate device
@@ -241,7 +261,7 @@ async def settings_get_device(data, device_uuid):
 async def settings_create_device(data, name, node_uuid, device_type, config):
     # Make sure node exists
     try:
-        node = await api.db.get(
+        await api.db.get(
             f"nodes/{node_uuid}"
         )
 
@@ -279,15 +299,45 @@ async def settings_create_device(data, name, node_uuid, device_type, config):
         device_data
     )
 
-    node["devices"].append(device_uuid)
+    # Appended to whatever's stored at the time, so concurrent
+    # creates, in this process or others, don't drop each other
+    added = await api.db.modify_many({
+        f"nodes/{node_uuid}": functools.partial(add_device, device_uuid = device_uuid)
+    })
 
-    await api.db.put(
-        f"nodes/{node_uuid}",
-        node
-    )
+    if not added:
+        # Node was deleted in the meantime
+        await api.db.delete(
+            f"devices/{device_uuid}"
+        )
+
+        return messenger.error(
+            "NotFound",
+            f"Node {node_uuid} does not exist"
+        )
+
+    api.db.principals.invalidate()
 
     return messenger.send(device_data)
 
+def add_device(
+        node: Optional[dict],
+        device_uuid: str
+    ) -> Optional[dict]:
+    if node is None:
+        return None
+
+    return {**node, "devices": [*node["devices"], device_uuid]}
+
+def remove_device(
+        node: Optional[dict],
+        device_uuid: str
+    ) -> Optional[dict]:
+    if node is None or device_uuid not in node["devices"]:
+        return None
+
+    return {**node, "devices": [x for x in node["devices"] if x != device_uuid]}
+
 def validate_device(
         device_type: str,
         config: Optional[dict]
@@ -332,7 +382,7 @@ def validate_device(
 @api.validate({"device": str, "changes": dict})
 async def settings_edit_device(data, device_uuid, changes):
     try:
-        device = copy.copy(await api.db.get(
+        device = misc.thaw(await api.db.get(
             f"devices/{device_uuid}"
         ))
 
@@ -417,6 +467,16 @@ async def settings_edit_device(data, device_uuid, changes):
                     # Add to comp
                     comp_[key] = details[key]
 
+                if details["type"] == "fault":
+                    # Store spelled-out names as their operator
+                    comp_["comparison"] = events.aliases.get(comp_["comparison"].lower(), comp_["comparison"])
+
+                if details["type"] == "fault" and comp_["comparison"] not in events.comparisons:
+                    return messenger.error(
+                        "ArgError",
+                        f"Event {event_name} has invalid comparison (req: one of {', '.join(events.comparisons)})"
+                    )
+
                 comp[event_name] = {
                     "type": details["type"],
                     **comp_
@@ -437,6 +497,9 @@ async def settings_edit_device(data, device_uuid, changes):
         device
     )
 
+    api.db.principals.invalidate()
+    api.events.compile(device)
+
     return messenger.success()
 
 @api.app.route("/settings/delete/device", methods = ["PUT"])
@@ -454,45 +517,44 @@ async def settings_delete_device(data, device_uuid):
             f"Device {device_uuid} doesn't exist"
         )
 
-    try:
-        node = await api.db.get(
-            f"nodes/{key['node']}"
-        )
-
-    except:
-        pass
-
-    else:
-        del node["devices"][node["devices"].index(device_uuid)]
+    await api.db.modify_many({
+        f"nodes/{key['node']}": functools.partial(remove_device, device_uuid = device_uuid)
+    })
 
-        await api.db.put(
-            f"nodes/{key['node']}",
-            node
-        )
+    await api.db.delete(
+        f"devices/{device_uuid}"
+    )
 
-    del api.db.interface.data["devices"][device_uuid]
+    api.history.remove(device_uuid)
+    api.events.remove(device_uuid)
 
-    await api.db.write()
+    api.db.principals.invalidate()
 
     return messenger.success()
 
 # -- NODES --
-node_keys = ["name", "uuid", "id", "devices", "last_updated", "last_updated_by", "data", "keys"]
-node_edit_keys = ["name", "keys"]
+node_keys = ["name", "uuid", "id", "devices", "last_updated", "last_updated_by", "data", "keys", "producer"]
+node_edit_keys = {"name": str, "keys": list, "producer": str}
 @api.app.route("/settings/get/nodes", methods = ["GET"])
 @api.auth("settings")
 async def settings_get_nodes(data):
+    override = "override" in data["__permissions__"]
+
+    # What's returned depends on which key is asking
+    tag = conditional.etag(api.db.version("nodes"), data["__key_uuid__"], override)
+
+    if conditional.matches(tag):
+        return conditional.not_modified(tag)
+
     comp = {}
 
     nodes = await api.db.get("nodes")
 
-    override = "override" in data["__permissions__"]
-
     for key_uuid, node_data in nodes.items():
         if data["__key_uuid__"] in node_data["keys"] or override:
             comp[key_uuid] = {x: y for x, y in node_data.items() if x in node_keys}
 
-    return messenger.send(comp)
+    return conditional.send(comp, tag)
 
 @api.app.route("/settings/get/node", methods = ["GET"])
 @api.auth("settings", True) # Validate node
@@ -527,7 +589,8 @@ async def settings_create_node(data, name):
         "last_updated": -1,
         "last_updated_by": None,
         "data": {},
-        "keys": [data["__key_uuid__"]]
+        "keys": [data["__key_uuid__"]],
+        "producer": data["__key_uuid__"]
     }
 
     await api.db.put(
@@ -535,16 +598,18 @@ async def settings_create_node(data, name):
         node_data
     )
 
+    api.db.principals.invalidate()
+
     return messenger.send(node_data)
 
 @api.app.route("/settings/edit/node", methods = ["PUT"])
 @api.auth("settings", True, False, False) # Authenticate with node
-@api.validate({"node": str, "changes": dict})
+@api.validate({"node": str, "changes": node_edit_keys})
 async def settings_edit_node(data, node_uuid, changes):
     try:
-        node = await api.db.get(
+        node = misc.thaw(await api.db.get(
             f"nodes/{node_uuid}"
-        )
+        ))
 
     except:
         return messenger.error(
@@ -552,32 +617,23 @@ async def settings_edit_node(data, node_uuid, changes):
             f"Node {node_uuid} doesn't exist"
         )
 
-    for change, new_value in changes.items():
-        if change not in node_edit_keys:
-            return messenger.error(
-                "ArgError",
-                f"Key {change} cannot be edited"
-            )
-
-        if change not in node:
-            return messenger.error(
-                "ArgError",
-                f"Key {change} does not exist"
-            )
+    # Every key in the schema can be set, including ones older
+    # nodes were stored without, like producer
+    node.update(changes)
 
-        if type(new_value) != type(node[change]):
-            return messenger.error(
-                "ArgError",
-                f"Key {change} is of wrong type"
-            )
-        
-        node[change] = new_value
+    if node.get("producer") is not None and node["producer"] not in node["keys"]:
+        return messenger.error(
+            "ArgError",
+            f"Producer {node['producer']} must be one of the node's keys"
+        )
 
     await api.db.put(
         f"nodes/{node_uuid}",
         node
     )
 
+    api.db.principals.invalidate()
+
     return messenger.success()
 
 @api.app.route("/settings/delete/node", methods = ["PUT"])
@@ -595,14 +651,22 @@ async def settings_delete_node(data, node_uuid):
             f"Node {node_uuid} doesn't exist"
         )
 
+    # Delete the node first, so no device can be added to it
+    # while its devices are being deleted
+    await api.db.delete(
+        f"nodes/{node_uuid}"
+    )
+
     # Delete all devices
     for device in key["devices"]:
-        if device in api.db.interface.data["devices"]:
-            del api.db.interface.data["devices"][device]
-            await api.db.write()
+        if device in await api.db.get("devices"):
+            await api.db.delete(
+                f"devices/{device}"
+            )
 
-    del api.db.interface.data["nodes"][node_uuid]
+        api.history.remove(device)
+        api.events.remove(device)
 
-    await api.db.write()
+    api.db.principals.invalidate()
 
     return messenger.success()
\ No newline at end of file
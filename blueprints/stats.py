@@ -1,6 +1,37 @@
+"""
+api.blueprints.stats
+
+Request instrumentation, and the metrics endpoint.
+"""
+
 import api
+from api.utils import metrics
+
+import time
+from quart import g, request
 
 @api.app.before_request
-async def update_stats(self):
-    # Add one to counter
-    api.db.data["stats"]["counter"] += 1
\ No newline at end of file
+async def start_timer():
+    g.request_start = time.perf_counter()
+
+@api.app.after_request
+async def record_request(response):
+    if "request_start" in g:
+        metrics.request_seconds.observe(
+            time.perf_counter() - g.request_start,
+            # Rules, not paths, so unknown URLs can't grow the series
+            request.url_rule.rule if request.url_rule is not None else "unmatched",
+            request.method,
+            response.status_code
+        )
+
+    return response
+
+@api.app.route("/admin/metrics", methods = ["GET"])
+@api.auth("admin")
+async def admin_metrics(data):
+    return (
+        metrics.render(),
+        200,
+        {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+    )
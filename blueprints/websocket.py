@@ -1,29 +1,81 @@
+"""
+api.blueprints.websocket
+
+Streaming data ingest for nodes, and live data
+pushes for dashboards.
+
+On /ws, a node authenticates once with its producer
+key, then streams data_put frames over the connection.
+Each frame is acknowledged or rejected individually,
+echoing back its "id" if one was sent. Trigger events
+on the node's devices are pushed back over the same
+connection.
+
+On /ws/subscribe, a client with the data permission
+authenticates, then subscribes to nodes or devices
+and is pushed their data whenever it's updated.
+
+Both re-check their key whenever the principal cache
+has been invalidated since the last check, so edited
+or deleted keys, ACLs and producers take effect on
+open connections too.
+"""
+
 import asyncio
+import time
+
+import api
+from . import data as data_blueprint
 
 from quart import copy_current_websocket_context, websocket
 
-import json
-from funcutils import wraps
+from api.utils import codec, metrics
+from functools import wraps
 
 connected = set()
 
 active_sockets = {}
 
-async def consumer():
-    authenticated = False
+outboxes = {}
 
+async def consumer(queue, ws_data):
     while True:
         data = await websocket.receive()
 
-        if not authenticated:
+        # Try to parse
+        try:
+            data = codec.loads(data)
+
+        except Exception as e:
+            await error(
+                "ParseError",
+                f"Invalid JSON message: {e}"
+            )
+            continue
+
+        if type(data) != dict:
+            await error(
+                "ParseError",
+                "Messages must be JSON objects"
+            )
+            continue
+
+        if not ws_data:
             # Check if this is an auth call
             if data.get("type") == "auth":
-                err, ws_data = await authenticate()
+                err, details = await authenticate(data, queue)
 
                 if err:
                     return # Stop accepting messages
 
-                authenticated = True # Good to go
+                ws_data.update(details)
+
+                await send(
+                    {
+                        "node": ws_data["node"]
+                    }
+                )
+                continue # Good to go
 
             else:
                 # They have to auth first
@@ -33,22 +85,19 @@ async def consumer():
                 )
                 return
 
-        # Try to parse
-        try:
-            data = json.loads(data)
+        # The key may have changed since
+        err = await recheck_producer(ws_data)
 
-        except Exception as e:
-            await error(
-                "ParseError",
-                f"Invalid JSON message: {e}"
-            )
-            continue
+        if err is not None:
+            await error(*err)
+            return
 
         # Check type
         if "type" not in data:
             await error(
                 "ArgError",
-                f"Missing required key 'type'"
+                f"Missing required key 'type'",
+                data.get("id")
             )
             continue
 
@@ -58,175 +107,546 @@ async def consumer():
         if msg_type not in actions:
             await error(
                 "ArgError",
-                f"Invalid action type {msg_type}"
+                f"Invalid action type {msg_type}",
+                data.get("id")
             )
             continue
 
         try:
             await actions[msg_type](
-                ws_data
+                ws_data,
+                data
             )
 
         except:
             await error(
                 "Exception",
-                f"An error occurred while executing action {msg_type}"
+                f"An error occurred while executing action {msg_type}",
+                data.get("id")
             )
             continue
 
-async def producer():
+async def producer(queue, ws_data):
     while True:
-        await asyncio.sleep(1)
+        message = await queue.get()
+
+        err = await recheck_producer(ws_data)
+
+        if err is not None:
+            await error(*err)
+            return
+
+        await send(message)
 
 def collect(function):
     @wraps(function)
     async def wrapper(*args, **kwargs):
         global connected
-        connected.add(websocket._get_current_object())
+        current = websocket._get_current_object()
+        connected.add(current)
+
+        endpoint = websocket.path
+        metrics.websocket_connections.inc(1, endpoint)
 
         try:
-            return await func(*args, **kwargs)
+            return await function(*args, **kwargs)
 
         finally:
-            current = websocket._get_current_object(_)
-            connected.remove(websocket._get_current_object())
+            connected.remove(current)
 
-            if current in active_sockets.values():
-                print("removing", [x for x, y in active_sockets.items() if y == current])
-                del active_sockets[[x for x, y in active_sockets.items() if y == current][0]]
+            metrics.websocket_connections.dec(1, endpoint)
+
+            for node_uuid in [x for x, y in active_sockets.items() if y == current]:
+                del active_sockets[node_uuid]
 
     return wrapper
 
-@app.websocket("/ws")
+@api.app.websocket("/ws")
 @collect
 async def ws():
+    queue = asyncio.Queue()
+
+    # Filled in by authenticate(), shared by both tasks
+    ws_data = {}
+
     consumer_task = asyncio.ensure_future(
-        copy_current_websocket_context(consumer)(),
+        copy_current_websocket_context(consumer)(queue, ws_data),
     )
     producer_task = asyncio.ensure_future(
-        copy_current_websocket_context(producer)(),
+        copy_current_websocket_context(producer)(queue, ws_data),
     )
 
     try:
-        await asyncio.gather(consumer_task, producer_task)
+        # The consumer returning means the connection is done
+        await asyncio.wait(
+            [consumer_task, producer_task],
+            return_when = asyncio.FIRST_COMPLETED
+        )
 
     finally:
         consumer_task.cancel()
         producer_task.cancel()
 
+        for node_uuid in [x for x, y in outboxes.items() if y is queue]:
+            del outboxes[node_uuid]
 
-async def error(
-        error_type: str,
-        message: str
-    ):
 
-    await websocket.send(
-        json.dumps(
-            {
-                "success": False,
-                "error": error_type,
-                "reason": message
-            }
-        )
-    )
+@api.app.websocket("/ws/subscribe")
+@collect
+async def ws_subscribe():
+    queue = api.subscriptions.connect()
 
-async def send(
-        data
-    ):
+    # Filled in on auth, shared by both tasks
+    state = {}
 
-    await websocket.send(
-        json.dumps(
-            {
-                "success": True,
-                "data": data
-            }
-        )
+    consumer_task = asyncio.ensure_future(
+        copy_current_websocket_context(subscribe_consumer)(queue, state),
     )
+    producer_task = asyncio.ensure_future(
+        copy_current_websocket_context(subscribe_producer)(queue, state),
+    )
+
+    try:
+        await asyncio.wait(
+            [consumer_task, producer_task],
+            return_when = asyncio.FIRST_COMPLETED
+        )
+
+    finally:
+        consumer_task.cancel()
+        producer_task.cancel()
+
+        api.subscriptions.disconnect(queue)
+
+async def subscribe_consumer(queue, state):
+    while True:
+        data = await websocket.receive()
 
-async def authenticate():
-    # Try to parse
         try:
-            data = json.loads(json)
+            data = codec.loads(data)
 
         except Exception as e:
-            # Send back an error
             await error(
                 "ParseError",
-                f"Couldn't parse message as JSON: {str(e)}"
+                f"Invalid JSON message: {e}"
             )
-            return True, None
+            continue
 
-        # Authenticate
-        if "key" not in data:
+        if type(data) != dict:
             await error(
-                "AuthError",
-                f"Missing key"
+                "ParseError",
+                "Messages must be JSON objects"
             )
-            return True, None
+            continue
+
+        frame_id = data.get("id")
+
+        if not state:
+            if data.get("type") != "auth":
+                await error(
+                    "AuthError",
+                    "You have to authenticate first"
+                )
+                return
 
-        keys = await api.db.get("keys")
+            generation = api.db.principals.generation
+            principal, err = await check_key(data.get("key"), "data")
 
-        key_uuid = None
-        for _uuid, _data in keys.items():
-            if _data["key"] == data["key"]:
-                key_uuid = _uuid
-                key_data = _data
+            if err is not None:
+                await error(*err)
+                return
 
-        if key_uuid is None:
-            await error(
-                "AuthError",
-                "Invalid key"
+            state.update({
+                "secret": data["key"],
+                "principal": principal,
+                "generation": generation
+            })
+
+            await send(
+                {
+                    "key": principal.uuid
+                },
+                frame_id
             )
-            return True, None
+            continue
+
+        # The key may have changed since
+        err = await recheck_subscriber(queue, state)
+
+        if err is not None:
+            await error(*err)
+            return
 
-        # Validate node
-        if "node" not in data:
+        principal = state["principal"]
+
+        if data.get("type") not in ["subscribe", "unsubscribe"]:
             await error(
                 "ArgError",
-                f"Missing node UUID"
+                f"Invalid action type {data.get('type')}",
+                frame_id
             )
-            return True, None
+            continue
+
+        if "node" in data:
+            kind, uuid = "node", data["node"]
+            allowed = principal.can_access_node(uuid)
 
-        nodes = await api.db.get("nodes")
+        elif "device" in data:
+            kind, uuid = "device", data["device"]
+            allowed = principal.can_access_device(uuid)
 
-        if data["node"] not in nodes:
+        else:
             await error(
                 "ArgError",
-                "Node does not exist"
+                "Either 'node' or 'device' must be specified",
+                frame_id
             )
-            return True, None
+            continue
 
-        node = nodes[data["node"]]
+        if data["type"] == "unsubscribe":
+            api.subscriptions.unsubscribe(queue, kind, uuid)
 
-        if key_uuid not in node["keys"]:
-            await error(
-                "PermError",
-                "You can't access this node"
-            )
-            return True, None
+        else:
+            if not allowed:
+                await error(
+                    "AuthError",
+                    f"Key {principal.uuid} cannot access {kind} {uuid}",
+                    frame_id
+                )
+                continue
 
-        # Make sure this key is the node's data sender
-        if key_uuid != node["producer"]:
-            await error(
-                "PermError",
-                "This key isn't registered as the node's data producer"
-            )
-            return True, None
+            api.subscriptions.subscribe(queue, kind, uuid)
+
+        await send(
+            {
+                kind: uuid
+            },
+            frame_id
+        )
+
+async def subscribe_producer(queue, state):
+    while True:
+        node_uuid, device_uuid, message = await queue.get()
+
+        err = await recheck_subscriber(queue, state)
+
+        if err is not None:
+            await error(*err)
+            return
 
-    # Make sure they're in active_sockets
-    if node["uuid"] not in active_sockets:
-        active_sockets[node["uuid"]] = websocket._get_current_object()
+        # Queued before the key lost access to it
+        principal = state["principal"]
 
-    # And make sure it's this one
-    elif active_sockets[node["uuid"]] != websocket._get_current_object():
-        active_sockets[node["uuid"]] = websocket._get_current_object()
+        if not (principal.can_access_node(node_uuid) or principal.can_access_device(device_uuid)):
+            continue
+
+        await websocket.send(message)
+
+async def check_key(
+        secret,
+        permission: str
+    ):
+    """
+    Resolves a key secret to its principal, and checks
+    it may be used from this connection.
+
+    Returns:
+        Principal, and (error type, message) or None
+    """
+
+    principal = await api.db.principals.get(secret)
+
+    if principal is None:
+        return None, ("AuthError", "Invalid key")
+
+    if not principal.allows_ip(websocket.remote_addr):
+        return None, ("AuthError", "Request not sent from whitelisted IP")
+
+    if permission not in principal.permissions:
+        return None, ("AuthError", f"You need permission {permission} to access this")
+
+    return principal, None
+
+async def recheck_producer(
+        ws_data: dict
+    ):
+    """
+    Checks a /ws connection's key is still its node's
+    producer, if principals changed since the last check.
+
+    Returns:
+        (error type, message), or None if it still is
+    """
+
+    generation = api.db.principals.generation
+
+    if ws_data.get("generation") == generation:
+        return None
+
+    principal, err = await check_key(ws_data["secret"], "settings")
+
+    if err is not None:
+        return err
+
+    nodes = await api.db.get("nodes")
+    node = nodes.get(ws_data["node"])
+
+    if node is None:
+        return "NotFound", "Node does not exist"
+
+    if not principal.can_access_node(node["uuid"]) or principal.uuid != node.get("producer"):
+        return "PermError", "This key isn't registered as the node's data producer"
+
+    ws_data["principal"] = principal
+    ws_data["generation"] = generation
+
+    return None
+
+async def recheck_subscriber(
+        queue,
+        state: dict
+    ):
+    """
+    Checks a /ws/subscribe connection's key is still valid,
+    if principals changed since the last check, and drops
+    subscriptions it can no longer access.
+
+    Returns:
+        (error type, message), or None if it still is
+    """
+
+    generation = api.db.principals.generation
+
+    if state["generation"] == generation:
+        return None
+
+    principal, err = await check_key(state["secret"], "data")
+
+    if err is not None:
+        return err
+
+    for kind, uuid in list(api.subscriptions.subscribers.get(queue, ())):
+        if kind == "node":
+            allowed = principal.can_access_node(uuid)
+
+        else:
+            allowed = principal.can_access_device(uuid)
+
+        if not allowed:
+            api.subscriptions.unsubscribe(queue, kind, uuid)
+
+    state["principal"] = principal
+    state["generation"] = generation
+
+    return None
+
+async def error(
+        error_type: str,
+        message: str,
+        frame_id = None
+    ):
+
+    comp = {
+        "success": False,
+        "error": error_type,
+        "reason": message
+    }
+
+    if frame_id is not None:
+        comp["id"] = frame_id
+
+    await websocket.send(
+        codec.dumps(comp)
+    )
+
+async def send(
+        data,
+        frame_id = None
+    ):
+
+    comp = {
+        "success": True,
+        "data": data
+    }
+
+    if frame_id is not None:
+        comp["id"] = frame_id
+
+    await websocket.send(
+        codec.dumps(comp)
+    )
+
+async def authenticate(data, queue):
+    # Authenticate
+    if "key" not in data:
+        await error(
+            "AuthError",
+            f"Missing key"
+        )
+        return True, None
+
+    generation = api.db.principals.generation
+    principal, err = await check_key(data["key"], "settings")
+
+    if err is not None:
+        await error(*err)
+        return True, None
+
+    # Validate node
+    if "node" not in data:
+        await error(
+            "ArgError",
+            f"Missing node UUID"
+        )
+        return True, None
+
+    nodes = await api.db.get("nodes")
+
+    if data["node"] not in nodes:
+        await error(
+            "ArgError",
+            "Node does not exist"
+        )
+        return True, None
+
+    key_uuid = principal.uuid
+    node = nodes[data["node"]]
+
+    if not principal.can_access_node(node["uuid"]):
+        await error(
+            "PermError",
+            "You can't access this node"
+        )
+        return True, None
+
+    # Make sure this key is the node's data sender
+    if key_uuid != node.get("producer"):
+        await error(
+            "PermError",
+            "This key isn't registered as the node's data producer"
+        )
+        return True, None
+
+    # Make sure this is the node's active socket
+    active_sockets[node["uuid"]] = websocket._get_current_object()
+    outboxes[node["uuid"]] = queue
 
     # Return websocket data
     return False, {
         "key": key_uuid,
-        "node": node["uuid"]
+        "node": node["uuid"],
+        "secret": data["key"],
+        "principal": principal,
+        "generation": generation
     }
 
 
 # -- ACTIONS --
-async def 
\ No newline at end of file
+async def action_data_put(
+        ws_data: dict,
+        data: dict
+    ):
+    frame_id = data.get("id")
+
+    for key, type_ in {"device": str, "data": dict}.items():
+        if type(data.get(key)) != type_:
+            await error(
+                "ArgError",
+                f"Key {key} must be of type {type_}",
+                frame_id
+            )
+            return
+
+    device_uuid = data["device"]
+
+    node = await api.db.get(
+        f"nodes/{ws_data['node']}"
+    )
+
+    if device_uuid not in node["devices"]:
+        await error(
+            "NotFound",
+            f"Device {device_uuid} is not registered to node {node['uuid']}",
+            frame_id
+        )
+        return
+
+    # Same check /data/put makes for a single device
+    principal = ws_data["principal"]
+
+    if not principal.can_access_device(device_uuid):
+        await error(
+            "AuthError",
+            f"Key {principal.uuid} cannot access device {device_uuid}",
+            frame_id
+        )
+        return
+
+    try:
+        device = await api.db.get(
+            f"devices/{device_uuid}"
+        )
+
+    except:
+        await error(
+            "NotFound",
+            f"Device {device_uuid} does not exist",
+            frame_id
+        )
+        return
+
+    valid, comp = data_blueprint.validate_data(device, data["data"])
+
+    if not valid:
+        await error(
+            comp["error"],
+            comp["reason"],
+            frame_id
+        )
+        return
+
+    timestamp = time.time()
+    previous = device["data"]
+    device = data_blueprint.apply_data(device, comp, timestamp, websocket.remote_addr)
+
+    await api.db.put(
+        f"devices/{device_uuid}",
+        device
+    )
+
+    await data_blueprint.after_ingest(device, previous, comp, timestamp)
+
+    await send(
+        {
+            "device": device_uuid
+        },
+        frame_id
+    )
+
+actions = {
+    "data_put": action_data_put
+}
+
+# -- EVENTS --
+async def push_trigger(
+        device: dict,
+        rule,
+        value
+    ):
+    # Send it to the node, if it's connected
+    queue = outboxes.get(device["node"])
+
+    if queue is None:
+        return
+
+    queue.put_nowait(
+        {
+            "type": "trigger",
+            "device": device["uuid"],
+            "event": rule.name,
+            "on_trigger": rule.on_trigger,
+            "value": value
+        }
+    )
+
+api.events.register("trigger", push_trigger)
@@ -1,25 +1,106 @@
 from quart import Quart
 import asyncio
+import os
+import sys
 import api
 
 api.app = Quart(__name__)
+api.app.json = api.utils.codec.JSONProvider(api.app)
+
+# For ASGI servers, e.g. hypercorn main:app
+app = api.app
 
 # Construct config
 config = api.classes.Config("config.yml")
 api.config = config
 asyncio.get_event_loop().run_until_complete(config.load())
+api.utils.logger.configure(**config.logging)
 
 # Construct database
-db = api.classes.Database()
+db = api.classes.Database(
+    config.storage["type"],
+    config.storage.get("options")
+)
 api.db = db
 asyncio.get_event_loop().run_until_complete(db.load())
 
+# Construct backups
+api.backups = api.classes.BackupManager(db, **config.backups)
+
+# Construct key usage accounting
+api.usage = api.classes.KeyUsage(db, config.usage["flush_interval"])
+
+# Construct history store
+api.history = api.classes.HistoryStore(
+    config.history["capacity"],
+    config.history.get("tiers")
+)
+
+# Construct subscription hub
+api.subscriptions = api.classes.SubscriptionHub()
+
+# Construct event engine
+api.events = api.classes.EventEngine()
+asyncio.get_event_loop().run_until_complete(api.events.load(db))
+
+# Construct alert dispatcher
+api.alerts = api.classes.AlertDispatcher(**config.alerts)
+api.alerts.configure(asyncio.get_event_loop().run_until_complete(db.get("settings")))
+api.events.register("fault", api.alerts.fault)
+
+# Follow changes made by other workers
+db.listen(api.events.changed)
+
+@api.app.before_serving
+async def startup():
+    api.db.start()
+    api.usage.start()
+    api.alerts.start()
+    api.backups.start()
+
+@api.app.before_request
+async def catch_up():
+    # Apply other workers' writes first, so a client sees
+    # its own writes whichever worker it reaches next
+    if api.db.shared:
+        await api.db.sync()
+
+@api.app.after_serving
+async def shutdown():
+    await api.alerts.stop()
+    await api.usage.stop()
+    await api.backups.stop()
+    await api.db.close()
+
 # Import blueprints
 import blueprints
 
 # Start
 if __name__ == "__main__":
-    api.app.run(
-        host = "0.0.0.0",
-        port = 6000
-    )
\ No newline at end of file
+    server = config.server
+
+    if server["workers"] == 1:
+        api.app.run(
+            host = server["host"],
+            port = server["port"]
+        )
+
+    else:
+        # Workers only see each other's writes through shared storage
+        if not db.shared:
+            raise api.utils.exceptions.InvalidInterface(
+                "Multiple workers need the sqlite interface with shared: true"
+            )
+
+        # Hand over to hypercorn, which imports main:app once
+        # per worker. Its workers are spawned, so running it
+        # from here would import this file twice in each.
+        os.execv(
+            sys.executable,
+            [
+                sys.executable, "-m", "hypercorn",
+                "--bind", f"{server['host']}:{server['port']}",
+                "--workers", str(server["workers"]),
+                "main:app"
+            ]
+        )
\ No newline at end of file